@@ -1,25 +1,45 @@
+import hashlib
 import json
 import os
 import random
 import string
-import uuid
+import time
+from collections import Counter
+from datetime import datetime
 from functools import wraps
 
-import httplib2
-import requests
 from flask import Flask, jsonify, redirect, render_template, request, url_for
 from flask import flash
-from flask import g, make_response
+from flask import Response, g, make_response, stream_with_context
+from flask import abort, has_request_context
 from flask import session as login_session
 from flask_httpauth import HTTPBasicAuth
-from oauth2client.client import FlowExchangeError
-from oauth2client.client import flow_from_clientsecrets
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event, func, literal, select, tuple_
+from sqlalchemy.orm import raiseload, scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
 
-from model import Base, Category, Item, User
+from bulk import BulkImport, export_ndjson, read_csv, read_ids, \
+    read_ndjson, update_items
+from cache import FragmentCacheExtension, LRUBackend, ResponseCache, \
+    TemplateBytecodeCache, precompile_templates
+from changes import ChangeNotifier, bury_items, count_items, format_cursor, \
+    parse_cursor, read_changes, serialize_change, track_changes
+from database import DATABASE_BUSY_TIMEOUT, DATABASE_MAX_OVERFLOW, \
+    DATABASE_POOL_RECYCLE, DATABASE_POOL_SIZE, DATABASE_REPLICA_URLS, \
+    DATABASE_URL, Database, RoutingSession
+from images import VariantWorker, is_variant, variant_filename
+from metrics import Metrics, SampledProfiler, TimedTemplate, record
+from migrations import migrate
+from oauth import GOOGLE_CERTS_URL, GOOGLE_REVOKE_URL, GOOGLE_TOKEN_URL, \
+    GOOGLE_TOKENINFO_URL, GOOGLE_USERINFO_URL, GoogleClient, id_token_subject
+from model import Category, Item, PendingDeletion, Tombstone, User, \
+    format_price, load_secret_key, parse_price, search
+from serializers import CATEGORY_SCHEMA, ITEM_SCHEMA, dumps
+from sessions import SQLiteSessionStore, ServerSessionInterface
+from uploads import PictureReaper, UploadRequest, UploadSpool, \
+    send_upload, store_upload, upload_path
 
 auth = HTTPBasicAuth()
 ##
@@ -29,20 +49,493 @@ auth = HTTPBasicAuth()
 
 UPLOAD_FOLDER = 'static/uploads/'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'ico'}
-CLIENT_ID = json.loads(
-        open('client_secret.json', 'r').read())['web']['client_id']
+# Requests with larger body are rejected before they are read
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+# Limits of a single uploaded picture - size in bytes and width/height
+UPLOAD_MAX_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_DIMENSION = 8000
+# Threads resizing uploaded pictures and whether to create WebP variants too
+IMAGE_WORKERS = 2
+IMAGE_WEBP = False
+# Seconds between checks of the queue of files to delete (it's also checked
+# after every commit queuing a deletion)
+PICTURE_REAPER_INTERVAL = 60
+# Let the front proxy send uploaded files - None (the app sends them),
+# 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx, requires an
+# internal location serving UPLOAD_FOLDER under UPLOADS_ACCEL_PREFIX)
+UPLOADS_SENDFILE = None
+UPLOADS_ACCEL_PREFIX = '/uploads/'
+# OAuth client of the app from Google Developers Console
+CLIENT_SECRETS_FILE = 'client_secret.json'
 APPLICATION_NAME = "Item App Application"
 
+# Outbound calls to Google - timeout (seconds), connections kept per host
+# and threads revoking tokens on logout in the background (0 revokes them
+# synchronously)
+OAUTH_TIMEOUT = 5
+OAUTH_POOL_SIZE = 10
+OAUTH_REVOKE_WORKERS = 0
+
+# Default and maximal number of records returned by one API page
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Number of rows inserted in a single transaction by the bulk import
+BULK_BATCH_SIZE = 1000
+# Maximal number of items in one batch request - keeps IN (...) lists under
+# the 999 parameters limit of older SQLite versions
+API_BATCH_MAX_SIZE = 500
+
+# Number of search results on a single page
+SEARCH_PAGE_SIZE = 20
+# Number of rows fetched from the DB cursor at once in the streaming mode
+API_STREAM_BATCH = 500
+# Change feed - longest wait of a long-poll request (seconds), how often
+# waiting requests check the DB for changes of other processes and how long
+# an event stream stays open (clients reconnect with the Last-Event-ID)
+CHANGES_MAX_WAIT = 30
+CHANGES_POLL_INTERVAL = 1
+CHANGES_STREAM_TIMEOUT = 300
+CHANGES_KEEPALIVE = 15
+
+# Login sessions are kept on the server - 'sqlite' (in SESSION_FILE, shared
+# by all worker processes) or 'memory' (a single worker process only).
+# Sessions unused for SESSION_TTL seconds expire.
+SESSION_STORE = 'sqlite'
+SESSION_FILE = 'sessions.db'
+SESSION_TTL = 7 * 24 * 3600
+SESSION_CACHE_SIZE = 10000
+# Seconds a verified API token is remembered (skips signature checks)
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_SIZE = 10000
+
+# Entries kept by the in-process response cache and their lifetime (seconds)
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TIMEOUT = 300
+# Backend of the response cache, None is the in-process LRU (of
+# RESPONSE_CACHE_SIZE entries). Invalidations reach other worker processes
+# only through a shared backend - with more workers use e.g.
+# cache.SharedBackend(redis.StrictRedis())
+RESPONSE_CACHE_BACKEND = None
+# Rendered {% cache %} fragments of templates (item and category cards)
+# shared by all users - number of entries and their lifetime (seconds)
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE_TIMEOUT = 3600
+# Folder of compiled templates shared by worker processes, None keeps them
+# in memory only. Templates are compiled by create_app().
+TEMPLATE_CACHE_FOLDER = 'template_cache/'
+
+# Treat views exceeding their SQL query budget as errors (always in testing)
+SQL_QUERY_BUDGET_STRICT = False
+
+# SQL queries slower than this (seconds) are logged with their statement
+SLOW_QUERY_THRESHOLD = 0.1
+# Part of requests run under cProfile (0.01 = 1%, 0 is off) - profiles of
+# requests slower than PROFILE_THRESHOLD seconds are saved to PROFILE_FOLDER
+PROFILE_SAMPLE_RATE = 0
+PROFILE_THRESHOLD = 1.0
+PROFILE_FOLDER = 'profiles/'
+# Addresses allowed to read /metrics, None allows everybody
+METRICS_ALLOWED_IPS = ('127.0.0.1',)
+
+# Create tables and apply pending migrations in create_app() - otherwise run
+# 'python3 migrations.py upgrade' before starting the app
+DATABASE_MIGRATE = False
+
 ##
 # FLASK INITIALIZATION
 ##
+# Views are registered on the app when this module is imported, everything
+# else is set up by create_app(). Importing the module reads no files and
+# opens no connections.
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-engine = create_engine('sqlite:///itemsapp.db')
-Base.metadata.bind = engine
+# uploaded files are streamed to disk and validated while they are received
+app.request_class = UploadRequest
+
+# Engines are created on the first use, separately in every worker process
+db = Database()
+DBSession = sessionmaker(class_=RoutingSession, database=db)
+# Every thread (request) gets its own session, removed after the request
+session = scoped_session(DBSession)
+# Modified categories and items get versions read by the change feed
+change_notifier = ChangeNotifier()
+track_changes(DBSession, change_notifier)
+
+
+def cache_identity():
+    """
+    :return: Identity of the user the response is rendered for - id of the
+             logged user or of the API token's owner
+    """
+    return login_session.get('user_id') or g.get('user_id')
+
+
+# Rendered pages and API responses. The backend is set by create_app() -
+# see RESPONSE_CACHE_BACKEND.
+response_cache = ResponseCache(identity=cache_identity)
+metrics = Metrics()
+
+# Set up by create_app()
+# Recently verified API tokens: token -> user id
+verified_tokens = None
+google = None
+variant_worker = None
+picture_reaper = None
+profiler = None
+
+
+def load_client_secrets(path):
+    """
+    Reads OAuth client id and secret of the app from the client secrets file.
+
+    :param path: Path of the JSON file downloaded from Google
+    :return: tuple (client id, client secret), (None, None) if there is no
+             file (Google Sign-In is off)
+    """
+    try:
+        with open(path, 'r') as secrets_file:
+            client = json.load(secrets_file)['web']
+            return client['client_id'], client.get('client_secret')
+    except IOError:
+        app.logger.warning("There is no '{}' file - Google Sign-In won't "
+                           "work.".format(path))
+        return None, None
+
+
+def create_app(config=None):
+    """
+    Configures the app and it's services. Called once per process, e.g. by
+    'gunicorn --preload "app:create_app()"' before the workers are forked -
+    database connections and background threads are created later, in every
+    worker separately.
+
+    There is a single app per process - calling it again (e.g. in tests or
+    the benchmark) configures the same app from scratch: the configuration
+    is reset to the defaults, the engines, the session store and the caches
+    are replaced and threads of the previous call are stopped.
+
+    :param config: dict overriding the default configuration (e.g. in tests)
+    :return: Flask app
+    """
+    global verified_tokens, google, variant_worker, picture_reaper, profiler
+
+    # nothing is kept from a previous call, keys it loaded included
+    app.config = app.make_config()
+    if google is not None:
+        google.close()
+    if variant_worker is not None:
+        variant_worker.shutdown()
+    if picture_reaper is not None:
+        picture_reaper.stop()
+    db.dispose()
+
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    app.config['UPLOAD_MAX_SIZE'] = UPLOAD_MAX_SIZE
+    app.config['UPLOAD_MAX_DIMENSION'] = UPLOAD_MAX_DIMENSION
+    app.config['IMAGE_WORKERS'] = IMAGE_WORKERS
+    app.config['IMAGE_WEBP'] = IMAGE_WEBP
+    app.config['PICTURE_REAPER_INTERVAL'] = PICTURE_REAPER_INTERVAL
+    app.config['UPLOADS_SENDFILE'] = UPLOADS_SENDFILE
+    app.config['UPLOADS_ACCEL_PREFIX'] = UPLOADS_ACCEL_PREFIX
+    # database settings are read from the environment - see database.py
+    app.config['DATABASE_URL'] = DATABASE_URL
+    app.config['DATABASE_REPLICA_URLS'] = DATABASE_REPLICA_URLS
+    app.config['DATABASE_POOL_SIZE'] = DATABASE_POOL_SIZE
+    app.config['DATABASE_POOL_RECYCLE'] = DATABASE_POOL_RECYCLE
+    app.config['DATABASE_MAX_OVERFLOW'] = DATABASE_MAX_OVERFLOW
+    app.config['DATABASE_BUSY_TIMEOUT'] = DATABASE_BUSY_TIMEOUT
+    app.config['SQL_QUERY_BUDGET_STRICT'] = SQL_QUERY_BUDGET_STRICT
+    app.config['SLOW_QUERY_THRESHOLD'] = SLOW_QUERY_THRESHOLD
+    app.config['PROFILE_SAMPLE_RATE'] = PROFILE_SAMPLE_RATE
+    app.config['PROFILE_THRESHOLD'] = PROFILE_THRESHOLD
+    app.config['PROFILE_FOLDER'] = PROFILE_FOLDER
+    app.config['METRICS_ALLOWED_IPS'] = METRICS_ALLOWED_IPS
+    app.config['OAUTH_TIMEOUT'] = OAUTH_TIMEOUT
+    app.config['OAUTH_POOL_SIZE'] = OAUTH_POOL_SIZE
+    app.config['OAUTH_REVOKE_WORKERS'] = OAUTH_REVOKE_WORKERS
+    # point these to a stub server in tests
+    app.config['GOOGLE_TOKEN_URL'] = GOOGLE_TOKEN_URL
+    app.config['GOOGLE_TOKENINFO_URL'] = GOOGLE_TOKENINFO_URL
+    app.config['GOOGLE_USERINFO_URL'] = GOOGLE_USERINFO_URL
+    app.config['GOOGLE_REVOKE_URL'] = GOOGLE_REVOKE_URL
+    app.config['GOOGLE_CERTS_URL'] = GOOGLE_CERTS_URL
+    app.config['SESSION_STORE'] = SESSION_STORE
+    app.config['SESSION_FILE'] = SESSION_FILE
+    app.config['SESSION_TTL'] = SESSION_TTL
+    app.config['SESSION_CACHE_SIZE'] = SESSION_CACHE_SIZE
+    app.config['TOKEN_CACHE_TTL'] = TOKEN_CACHE_TTL
+    app.config['TOKEN_CACHE_SIZE'] = TOKEN_CACHE_SIZE
+    app.config['RESPONSE_CACHE_SIZE'] = RESPONSE_CACHE_SIZE
+    app.config['RESPONSE_CACHE_TIMEOUT'] = RESPONSE_CACHE_TIMEOUT
+    app.config['RESPONSE_CACHE_BACKEND'] = RESPONSE_CACHE_BACKEND
+    app.config['FRAGMENT_CACHE_SIZE'] = FRAGMENT_CACHE_SIZE
+    app.config['FRAGMENT_CACHE_TIMEOUT'] = FRAGMENT_CACHE_TIMEOUT
+    app.config['TEMPLATE_CACHE_FOLDER'] = TEMPLATE_CACHE_FOLDER
+    app.config['CLIENT_SECRETS_FILE'] = CLIENT_SECRETS_FILE
+    app.config['DATABASE_MIGRATE'] = DATABASE_MIGRATE
+    app.config.update(config or {})
+
+    if not app.config.get('SECRET_KEY'):
+        # shared by all workers and kept across restarts - see
+        # model.load_secret_key
+        app.config['SECRET_KEY'] = load_secret_key()
+    if 'CLIENT_ID' not in app.config:
+        app.config['CLIENT_ID'], app.config['CLIENT_SECRET'] = \
+            load_client_secrets(app.config['CLIENT_SECRETS_FILE'])
+
+    db.configure(app.config['DATABASE_URL'],
+                 app.config['DATABASE_REPLICA_URLS'],
+                 pool_size=app.config['DATABASE_POOL_SIZE'],
+                 max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+                 busy_timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+                 pool_recycle=app.config['DATABASE_POOL_RECYCLE'])
+
+    if app.config['DATABASE_MIGRATE']:
+        # creates the tables and applies pending schema migrations
+        migrate(db.engine)
+        # forked workers must not inherit the connection
+        db.dispose()
+
+    if app.config['SESSION_STORE'] == 'memory':
+        session_store = LRUBackend(app.config['SESSION_CACHE_SIZE'])
+    else:
+        session_store = SQLiteSessionStore(app.config['SESSION_FILE'])
+    app.session_interface = ServerSessionInterface(
+            session_store, ttl=app.config['SESSION_TTL'],
+            # uploaded pictures are served below the static path too
+            skip_paths=[app.static_url_path + '/', '/metrics'])
+
+    verified_tokens = LRUBackend(app.config['TOKEN_CACHE_SIZE'])
+    response_cache.backend = app.config['RESPONSE_CACHE_BACKEND'] or \
+        LRUBackend(app.config['RESPONSE_CACHE_SIZE'])
+    response_cache.timeout = app.config['RESPONSE_CACHE_TIMEOUT']
+
+    google = GoogleClient(app.config['CLIENT_ID'],
+                          client_secret=app.config.get('CLIENT_SECRET'),
+                          timeout=app.config['OAUTH_TIMEOUT'],
+                          pool_size=app.config['OAUTH_POOL_SIZE'],
+                          token_url=app.config['GOOGLE_TOKEN_URL'],
+                          tokeninfo_url=app.config['GOOGLE_TOKENINFO_URL'],
+                          userinfo_url=app.config['GOOGLE_USERINFO_URL'],
+                          revoke_url=app.config['GOOGLE_REVOKE_URL'],
+                          certs_url=app.config['GOOGLE_CERTS_URL'],
+                          background_workers=app.config[
+                              'OAUTH_REVOKE_WORKERS'])
+
+    variant_worker = VariantWorker(app.config['UPLOAD_FOLDER'],
+                                   max_workers=app.config['IMAGE_WORKERS'],
+                                   webp=app.config['IMAGE_WEBP'])
+
+    # started by the first request of every worker
+    picture_reaper = PictureReaper(
+            DBSession, app.config['UPLOAD_FOLDER'], PendingDeletion,
+            (Item, Category), interval=app.config['PICTURE_REAPER_INTERVAL'])
+
+    profiler = SampledProfiler(app.config['PROFILE_FOLDER'],
+                               sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+                               threshold=app.config['PROFILE_THRESHOLD'])
+    # every render_template records it's time
+    app.jinja_env.template_class = TimedTemplate
+
+    if FragmentCacheExtension.identifier not in app.jinja_env.extensions:
+        app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache = LRUBackend(
+            app.config['FRAGMENT_CACHE_SIZE'])
+    app.jinja_env.fragment_cache_timeout = app.config['FRAGMENT_CACHE_TIMEOUT']
+    app.jinja_env.bytecode_cache = None
+    if app.config['TEMPLATE_CACHE_FOLDER']:
+        app.jinja_env.bytecode_cache = TemplateBytecodeCache(
+                app.config['TEMPLATE_CACHE_FOLDER'])
+    # workers don't compile templates on their first requests
+    precompile_templates(app.jinja_env)
+
+    return app
+
+
+@app.before_request
+def start_background_workers():
+    """
+    Starts threads of the worker process (once, the first request does).
+    """
+    picture_reaper.start()
+
+
+@event.listens_for(DBSession, 'after_commit')
+def wake_picture_reaper(db_session):
+    """
+    Lets the reaper delete files queued by the committed transaction.
+    """
+    if db_session.info.pop('pictures_queued', False):
+        picture_reaper.wake()
+
+
+# takes precedence over the static route - it's more specific
+@app.route('/static/uploads/<path:filename>')
+def uploaded_file(filename):
+    """
+    Sends uploaded picture with a strong ETag and headers letting browsers
+    cache it forever - see uploads.send_upload. A variant not generated yet
+    is queued and redirects to the original meanwhile.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    path = upload_path(folder, filename)
+
+    if path and is_variant(filename) and not os.path.isfile(path):
+        # 'abc.thumb.jpg' is a variant of 'abc.png', 'abc.gif', ...
+        stem = os.path.splitext(os.path.splitext(filename)[0])[0]
+        for extension in ALLOWED_EXTENSIONS:
+            original = '{}.{}'.format(stem, extension)
+            if os.path.isfile(os.path.join(folder, original)):
+                variant_worker.ready(original)
+                return redirect(url_for('uploaded_file', filename=original))
+
+    return send_upload(folder, filename,
+                       app.config['UPLOADS_SENDFILE'],
+                       app.config['UPLOADS_ACCEL_PREFIX'])
+
+
+@app.before_request
+def route_reads():
+    """
+    Read-only (GET) requests read from the replicas, if there are any - see
+    database.RoutingSession. GET views marked with @changes_data check what
+    they change on the primary, a lagging replica could miss it.
+    """
+    view = app.view_functions.get(request.endpoint)
+    session.info['use_replica'] = request.method in ('GET', 'HEAD') and \
+        not getattr(view, 'changes_data', False)
 
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    """
+    Closes request's session and returns it's connection to the pool.
+    Uncommitted changes (e.g. after a failed commit) are rolled back, so the
+    next request always starts with a clean session.
+    """
+    session.remove()
+
+
+def count_sql_query(conn, cursor, statement, parameters, context,
+                    executemany):
+    """
+    Counts SQL statements executed while handling the current request.
+    """
+    if has_request_context():
+        g.sql_query_count = g.get('sql_query_count', 0) + 1
+
+
+@app.after_request
+def check_query_budget(response):
+    """
+    Compares number of SQL statements executed by the view with it's budget
+    declared with @query_budget. Exceeding the budget is logged, in testing
+    (or with SQL_QUERY_BUDGET_STRICT) it raises an error, so N+1 regressions
+    fail the tests.
+    """
+    count = g.get('sql_query_count', 0)
+    budget = g.get('sql_query_budget')
+
+    if app.debug or app.testing:
+        response.headers['X-SQL-Query-Count'] = str(count)
+
+    if budget is not None and count > budget:
+        message = "View '{}' executed {} SQL queries, it's budget is {}." \
+            .format(request.endpoint, count, budget)
+
+        if app.testing or app.config['SQL_QUERY_BUDGET_STRICT']:
+            raise RuntimeError(message)
+
+        app.logger.warning(message)
+
+    return response
+
+
+##
+# METRICS
+##
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profile = profiler.start()
+
+
+def start_sql_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def stop_sql_timer(conn, cursor, statement, parameters, context,
+                   executemany):
+    """
+    Records time of the SQL statement and logs it if it's slow.
+    """
+    starts = conn.info.get('query_start')
+    if not starts:
+        # started before the listeners were registered
+        return
+
+    duration = time.perf_counter() - starts.pop()
+    record('db', duration)
+
+    if duration >= app.config['SLOW_QUERY_THRESHOLD']:
+        metrics.slow_query()
+        app.logger.warning("Slow SQL query ({:.3f} s): {} {}".format(
+                duration, statement, parameters))
+
+
+# SQL statements of the primary and the replicas are counted and timed
+db.listen('before_cursor_execute', count_sql_query)
+db.listen('before_cursor_execute', start_sql_timer)
+db.listen('after_cursor_execute', stop_sql_timer)
+
+
+@app.after_request
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception=None):
+    """
+    Adds the finished request to the metrics. Runs after streamed responses
+    are sent completely, so their whole time is counted.
+    """
+    if 'request_start' not in g:
+        return
+
+    duration = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    status = 500 if exception is not None else g.get('response_status', 500)
+
+    metrics.observe(endpoint, status, duration,
+                    g.get('metrics_timings', {}),
+                    g.get('sql_query_count', 0))
+
+    if g.profile is not None:
+        path = profiler.stop(g.profile, duration, endpoint)
+        if path is not None:
+            app.logger.warning("Slow request to '{}' ({:.3f} s), profile "
+                               "saved to: {}".format(request.path, duration,
+                                                     path))
+
+
+@app.route('/metrics')
+def metrics_view():
+    """
+    Exposes request metrics for Prometheus.
+
+    :return: Metrics in Prometheus text format
+    """
+    allowed = app.config['METRICS_ALLOWED_IPS']
+    if allowed is not None and request.remote_addr not in allowed:
+        abort(403)
+
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 ##
@@ -61,16 +554,144 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
 
+def save_picture(picture):
+    """
+    Saves uploaded picture in the uploads folder under the name derived from
+    it's content and queues generation of it's resized variants. Pictures
+    with the same content are stored only once. Invalid or too large images
+    are rejected with 415/413 error.
+
+    :param picture: FileStorage from request.files
+    :return: Name of the saved file
+    """
+    if isinstance(picture.stream, UploadSpool):
+        # already on disk, type and size checked - just move it in place
+        filename, created = picture.stream.store(
+                app.config['UPLOAD_MAX_DIMENSION'])
+    else:
+        extension = os.path.splitext(secure_filename(picture.filename))[1]
+        filename, created = store_upload(
+                picture.stream, app.config['UPLOAD_FOLDER'], extension)
+
+    if created:
+        variant_worker.schedule(filename)
+
+    return filename
+
+
+def delete_pictures(filenames):
+    """
+    Queues pictures (together with their resized variants) for deletion.
+    Has to be called before the commit removing their references - the
+    queue is a table, so it's written in the same transaction. Files are
+    deleted in the background by picture_reaper, unless another item or
+    category still uses them.
+
+    :param filenames: Names of the files with the extension
+    """
+    queued_at = time.time()
+    for filename in set(filename for filename in filenames if filename):
+        session.add(PendingDeletion(filename=filename, queued_at=queued_at))
+        session.info['pictures_queued'] = True
+
+
 def delete_picture(filename):
     """
-    Finds appropriate picture in the uploads folder and deletes it
+    Queues appropriate picture in the uploads folder for deletion. Has to be
+    called before the commit.
     :param filename: Name of the file with the extension
     """
-    if filename:
-        try:
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        except OSError:
-            print("There was an error deleting file: '{}'.".format(filename))
+    delete_pictures([filename])
+
+
+def delete_category_items(category_id):
+    """
+    Deletes all items of the category with a single DELETE statement and
+    queues their pictures for deletion with a single INSERT ... SELECT - no
+    item is loaded into the session. Has to be called before the commit.
+
+    :param category_id: Id of the category
+    """
+    pictures = select([Item.picture, literal(time.time())]) \
+        .where(Item.category_id == category_id) \
+        .where(Item.picture.isnot(None)) \
+        .distinct()
+    session.execute(PendingDeletion.__table__.insert().from_select(
+            ['filename', 'queued_at'], pictures))
+    bury_items(session, Item.category_id == category_id)
+
+    session.query(Item).filter_by(category_id=category_id) \
+        .delete(synchronize_session=False)
+    session.info['pictures_queued'] = True
+
+
+def delete_items(categories):
+    """
+    Deletes the items with a single DELETE statement and queues their
+    pictures for deletion with a single INSERT ... SELECT. Has to be called
+    before the commit.
+
+    :param categories: dict id of an existing item -> id of it's category
+    """
+    item_ids = list(categories)
+
+    pictures = select([Item.picture, literal(time.time())]) \
+        .where(Item.id.in_(item_ids)) \
+        .where(Item.picture.isnot(None)) \
+        .distinct()
+    session.execute(PendingDeletion.__table__.insert().from_select(
+            ['filename', 'queued_at'], pictures))
+    bury_items(session, Item.id.in_(item_ids))
+
+    session.query(Item).filter(Item.id.in_(item_ids)) \
+        .delete(synchronize_session=False)
+    session.info['pictures_queued'] = True
+
+    deltas = Counter()
+    for category_id in categories.values():
+        deltas[category_id] -= 1
+    count_items(session, deltas)
+
+
+@app.template_filter('date')
+def format_date(timestamp):
+    """
+    Formats time.time() timestamp as a date for templates.
+    """
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+
+@app.template_filter('price')
+def price_filter(cents):
+    """
+    Formats price in minor units for templates, e.g. 1250 as '12.50'.
+    """
+    return format_price(cents) or ''
+
+
+@app.template_global()
+def picture_url(filename, variant='original'):
+    """
+    Returns URL of the picture's variant for templates. Falls back to the
+    original while the variant is not generated yet (missing variants are
+    queued), and to the placeholder if there is no picture.
+
+    :param filename: Name of the uploaded picture or None
+    :param variant: 'thumb', 'medium' or 'original'
+    :return: URL of the picture
+    """
+    if not filename:
+        return url_for('static', filename='empty_img.png')
+
+    if variant != 'original' and not variant_worker.ready(filename):
+        # don't cache the page until the variant is generated - if it
+        # can't be, the page with the original is cached as usual
+        if filename in variant_worker.pending:
+            response_cache.uncacheable()
+        return url_for('uploaded_file', filename=filename)
+
+    return url_for('uploaded_file',
+                   filename=variant_filename(filename, variant))
 
 
 def api_error(message):
@@ -93,6 +714,237 @@ def api_success(message):
     return jsonify({"success": message})
 
 
+def json_response(data):
+    """
+    Builds JSON response with serializers.dumps() - a lot faster than
+    jsonify for large listings.
+
+    :param data: Data to encode
+    :return: Response
+    """
+    return Response(dumps(data), mimetype='application/json')
+
+
+def invalidate_category(category_id, with_items=False):
+    """
+    Drops cached responses showing the category - the categories listing
+    and the category page.
+
+    :param category_id: Id of the modified category
+    :param with_items: True if category's items were changed too (deletion)
+    """
+    tags = ['categories', 'category:{}'.format(category_id)]
+    if with_items:
+        tags.append('category-items:{}'.format(category_id))
+
+    response_cache.invalidate(*tags)
+
+
+def invalidate_item(item_id, category_id):
+    """
+    Drops cached responses showing the item - the item itself, the page of
+    it's category and the categories listing (shows numbers of items).
+
+    :param item_id: Id of the modified item
+    :param category_id: Id of the category the item belongs to
+    """
+    response_cache.invalidate('item:{}'.format(item_id),
+                              'category:{}'.format(category_id),
+                              'categories')
+
+
+def get_page_args():
+    """
+    Reads keyset pagination arguments (?after_id=&limit=) from the request.
+
+    :return: tuple (after_id, limit) or None if arguments are invalid
+    """
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        return None
+
+    if after_id < 0 or limit < 1:
+        return None
+
+    return after_id, min(limit, API_MAX_PAGE_SIZE)
+
+
+def paginate(query, model, after_id, limit):
+    """
+    Fetches a single page of records with id greater than after_id. The
+    query walks the primary key index, so every page costs the same no matter
+    how deep the client is in the listing. Rows are fetched with a plain Core
+    statement - no ORM objects are built.
+
+    :param query: SQLAlchemy query selecting columns of the model, including
+                  it's id (see serializers.RowSerializer)
+    :param model: Model class, its id is used as the cursor
+    :param after_id: Id of the last record from the previous page
+    :param limit: Maximal number of records on the page
+    :return: tuple (rows, next_after_id) - next_after_id is None on the
+             last page
+    """
+    records = session.execute(query.filter(model.id > after_id)
+                              .order_by(model.id)
+                              .limit(limit + 1)
+                              .statement).fetchall()
+
+    if len(records) > limit:
+        records = records[:limit]
+        return records, records[-1].id
+
+    return records, None
+
+
+def next_page_url(next_after_id, limit, **values):
+    """
+    Builds URL of the next page for the current endpoint.
+
+    :return: URL or None if there is no next page
+    """
+    if next_after_id is None:
+        return None
+
+    return url_for(request.endpoint, after_id=next_after_id, limit=limit,
+                   **values)
+
+
+def get_price_args():
+    """
+    Reads price filters (?min_price=&max_price=, amounts in major units like
+    9.99) and ordering (?sort=price) of item listings. Pages ordered by
+    price continue after the price of the last item (?after_price=, in minor
+    units) and it's id.
+
+    :return: tuple (min_price, max_price, by_price, after_price) with prices
+             in minor units (None if not given) or None if arguments are
+             invalid
+    """
+    prices = []
+    for name in ('min_price', 'max_price'):
+        value = request.args.get(name, '')
+        price = parse_price(value) if value else None
+        if value and price is None:
+            return None
+        prices.append(price)
+
+    sort = request.args.get('sort', 'id')
+    if sort not in ('id', 'price'):
+        return None
+
+    try:
+        after_price = int(request.args.get('after_price', -1))
+    except ValueError:
+        return None
+
+    return prices[0], prices[1], sort == 'price', after_price
+
+
+def filter_by_price(query, min_price, max_price, by_price):
+    """
+    Limits items of a category to the price range. Listings ordered by price
+    leave out items without a price. The range is read from the
+    (category_id, price_cents, id) index.
+    """
+    if min_price is not None:
+        query = query.filter(Item.price_cents >= min_price)
+    if max_price is not None:
+        query = query.filter(Item.price_cents <= max_price)
+    if by_price:
+        query = query.filter(Item.price_cents.isnot(None))
+
+    return query
+
+
+def order_by_price(query, after_price=-1, after_id=0):
+    """
+    Orders items by price, then id, starting after the (price, id) of the
+    last item of the previous page. For items of a category the row value
+    comparison walks the (category_id, price_cents, id) index - no sorting,
+    pages deep in the listing cost the same as the first one.
+    """
+    return query.filter(tuple_(Item.price_cents, Item.id) >
+                        tuple_(after_price, after_id)) \
+        .order_by(Item.price_cents, Item.id)
+
+
+def paginate_by_price(query, after_price, after_id, limit):
+    """
+    Fetches a single page of items ordered by price - see paginate(). The
+    query has to select the price too.
+
+    :return: tuple (rows, next cursor) - the cursor is a tuple
+             (after_price, after_id) of the last item, None on the last page
+    """
+    items = session.execute(order_by_price(query, after_price, after_id)
+                            .limit(limit + 1)
+                            .statement).fetchall()
+
+    if len(items) > limit:
+        items = items[:limit]
+        return items, (items[-1].price_cents, items[-1].id)
+
+    return items, None
+
+
+def wants_stream():
+    """
+    :return: True if client asked for a streamed response (?stream=1)
+    """
+    return request.args.get('stream') in ('1', 'true')
+
+
+def stream_json(head, key, query, serializer):
+    """
+    Streams a JSON object with a list of serialized records. Rows are fetched
+    from the DB cursor in batches and sent as soon as they are serialized, so
+    the memory usage doesn't depend on the size of the listing.
+
+    :param head: dict with the fields sent before the list
+    :param key: Name of the list field
+    :param query: SQLAlchemy query selecting the serializer's columns
+    :param serializer: serializers.RowSerializer
+    :return: Streamed Response
+    """
+
+    def generate():
+        prefix = dumps(head)[:-1]
+        if head:
+            prefix += b','
+        yield prefix + dumps(key) + b':['
+
+        separator = b''
+        for row in query.yield_per(API_STREAM_BATCH):
+            yield separator + dumps(serializer(row))
+            separator = b','
+
+        yield b']}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def search_page(limit):
+    """
+    Runs the search for ?q=&page= arguments of the current request.
+
+    :param limit: Number of results on a page
+    :return: tuple (query, page, results, has_next)
+    """
+    query = request.args.get('q', '').strip()
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+
+    results = search(session, query, limit + 1, (page - 1) * limit)
+
+    return query, page, results[:limit], len(results) > limit
+
+
 def get_logged_user():
     """
     Process user that was authorized with Google. If user exists in DB
@@ -114,6 +966,156 @@ def get_logged_user():
     return user.id
 
 
+def get_current_user():
+    """
+    Returns User object of the logged user. The user is fetched from the DB
+    at most once per request and cached in flask.g.
+
+    :return: User or None if nobody is logged in
+    """
+    if 'user' not in g:
+        g.user = None
+
+        if 'user_id' in login_session:
+            g.user = session.query(User).filter_by(
+                    id=login_session['user_id']).one_or_none()
+
+    return g.user
+
+
+def changes_data(f):
+    """
+    Marks a GET view changing data (e.g. deleting by a link) - it's request
+    reads from the primary database, never from a replica. See route_reads.
+    """
+    f.changes_data = True
+    return f
+
+
+def query_budget(max_queries):
+    """
+    Declares the maximal number of SQL statements the view may execute while
+    handling a single request. Checked in check_query_budget.
+
+    :param max_queries: Number of allowed SQL statements
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.sql_query_budget = max_queries
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+def conditional(validator):
+    """
+    Answers conditional GET requests (If-None-Match, If-Modified-Since) with
+    304 Not Modified. The validator reads versions of the records shown by
+    the view with a single query, so an unchanged response is neither looked
+    up in the response cache nor serialized.
+
+    :param validator: Function taking the view's arguments and returning
+                      tuple (versions, last modification timestamp) or None
+                      if the records don't exist - versions is a list
+                      changing with every change of the response
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return f(*args, **kwargs)
+
+            validated = validator(*args, **kwargs)
+            if validated is None:
+                return f(*args, **kwargs)
+
+            versions, last_modified = validated
+            # the response depends on the arguments too (?after_id=...)
+            etag = hashlib.sha1(json.dumps(
+                    [versions, sorted(request.args.items(multi=True))])
+                                .encode('utf-8')).hexdigest()
+            last_modified = datetime.utcfromtimestamp(int(last_modified))
+
+            if is_resource_modified(request.environ, etag=etag,
+                                    last_modified=last_modified):
+                response = make_response(f(*args, **kwargs))
+            else:
+                response = Response(status=304)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # clients have to revalidate, which is cheap
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+def last_deletion():
+    """
+    :return: Scalar subquery - time of the latest deletion of any record
+    """
+    return select([Tombstone.deleted_at]) \
+        .order_by(Tombstone.version.desc(), Tombstone.id.desc()) \
+        .limit(1).as_scalar()
+
+
+def categories_versions():
+    """
+    Validator of categories_api - the latest version and number of
+    categories. A deletion always lowers the number, any other change raises
+    the latest version.
+    """
+    version, count, updated_at, deleted_at = session.execute(select([
+        func.max(Category.version), func.count(Category.id),
+        func.max(Category.updated_at), last_deletion()])).first()
+
+    return [version, count], max(updated_at or 0, deleted_at or 0)
+
+
+def category_versions(category_id):
+    """
+    Validator of category_api - version of the category and the latest
+    version and number of it's items.
+    """
+    in_category = Item.category_id == category_id
+
+    row = session.execute(select([
+        select([Category.version]).where(Category.id == category_id)
+        .as_scalar(),
+        select([func.max(Item.version)]).where(in_category).as_scalar(),
+        select([func.count(Item.id)]).where(in_category).as_scalar(),
+        select([Category.updated_at]).where(Category.id == category_id)
+        .as_scalar(),
+        select([func.max(Item.updated_at)]).where(in_category).as_scalar(),
+        last_deletion()])).first()
+
+    if row[0] is None:
+        return None
+
+    return list(row[:3]), max(value or 0 for value in row[3:])
+
+
+def item_versions(category_id, item_id):
+    """
+    Validator of item_api - version of the item.
+    """
+    row = session.query(Item.version, Item.updated_at) \
+        .filter_by(id=item_id, category_id=category_id).first()
+
+    if row is None:
+        return None
+
+    return [row.version], row.updated_at
+
+
 def login_protected(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -136,25 +1138,39 @@ def verify_api_credentials(token, password):
     Password is not used in this case, so it's left empty. Password argument is
     required for @auth.verify_password.
 
+    Verified tokens are remembered for TOKEN_CACHE_TTL seconds (never past
+    their expiration), so busy clients don't pay for the signature check on
+    every call. Id of the token's owner is stored in g.user_id.
+
     :param token: Token from Basic Auth 'name' field.
     :return: True if authenticated.
     """
-    user_id = User.verify_auth_token(token)
-
-    if not user_id:
+    if not token:
         return False
-    else:
-        return True
+
+    user_id = verified_tokens.get(token)
+
+    if user_id is None:
+        verified = User.read_auth_token(token)
+        if verified is None:
+            return False
+
+        user_id, expires = verified
+        ttl = min(app.config['TOKEN_CACHE_TTL'], expires - time.time())
+        if ttl > 0:
+            verified_tokens.set(token, user_id, ttl)
+
+    g.user_id = user_id
+    return True
 
 
 @app.route('/token')
 @login_protected
 def get_auth_token():
-    try:
-        user = session.query(User).filter_by(id=login_session['user_id']).one()
-    except NoResultFound:
+    user = get_current_user()
+    if user is None:
         # unexpected situation - login one more time
-        redirect(url_for("login_view"))
+        return redirect(url_for("login_view"))
 
     token = user.generate_auth_token()
     return jsonify({'token': token.decode('ascii')})
@@ -182,15 +1198,10 @@ def inject_user():
     if 'user_id' in login_session:
         user_id = login_session['user_id']
 
-    try:
-        user = session.query(User).filter_by(id=user_id).one()
-        g.user = user
-
-    except:
-        pass
-
+    # everything templates need is kept in the login session - the User
+    # object is loaded only on demand with get_current_user()
     return dict(user_name=user_name, user_pic=user_pic, user_id=user_id,
-                client_id=CLIENT_ID)
+                client_id=app.config['CLIENT_ID'])
 
 
 @app.errorhandler(404)
@@ -224,48 +1235,53 @@ def google_connect():
     # Obtain authorization code
     code = request.data
 
-    try:
-        # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secret.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+    # Upgrade the authorization code into tokens
+    tokens = google.exchange_code(code.decode('utf-8', 'replace'))
+    if tokens.get('error') is not None:
+        app.logger.warning("Failed to upgrade the authorization code: "
+                           "{}".format(tokens['error']))
         response = make_response(
                 json.dumps('Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
+    access_token = tokens['access_token']
+    id_token = tokens.get('id_token')
+    gplus_id = id_token_subject(id_token)
 
-    print(str(h.request(url, 'GET')[1]))
+    # Check that the token is valid and was issued to this app for the
+    # intended user. The id token's signature is verified locally with
+    # cached Google certificates, the tokeninfo endpoint is asked only when
+    # that's not possible.
+    claims = google.verify_id_token(id_token) if id_token else None
 
-    result = json.loads(h.request(url, 'GET')[1].decode())
-    # If there was an error in the access token info, abort.
-    if result.get('error') is not None:
-        response = make_response(json.dumps(result.get('error')), 500)
-        response.headers['Content-Type'] = 'application/json'
-        return response
+    if claims is not None:
+        token_user_id = claims['sub']
+    else:
+        result = google.tokeninfo(access_token)
+        # If there was an error in the access token info, abort.
+        if result.get('error') is not None:
+            response = make_response(json.dumps(result.get('error')), 500)
+            response.headers['Content-Type'] = 'application/json'
+            return response
+
+        # Verify that the access token is valid for this app.
+        if result['issued_to'] != app.config['CLIENT_ID']:
+            app.logger.warning("Token's client ID does not match app's.")
+            response = make_response(
+                    json.dumps("Token's client ID does not match app's."), 401)
+            response.headers['Content-Type'] = 'application/json'
+            return response
+
+        token_user_id = result['user_id']
 
     # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
+    if token_user_id != gplus_id:
         response = make_response(
                 json.dumps("Token's user ID doesn't match user ID."), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
-        response = make_response(
-                json.dumps("Token's client ID does not match app's."), 401)
-        print("Token's client ID does not match app's.")
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
     stored_access_token = login_session.get('access_token')
     stored_gplus_id = login_session.get('gplus_id')
 
@@ -276,19 +1292,22 @@ def google_connect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
+    # new session id for the signed in user
+    login_session.regenerate()
+
     # Store the access token in the session for later use.
-    login_session['access_token'] = credentials.access_token
+    login_session['access_token'] = access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
+    # the verified id token carries the profile (with the 'profile' scope),
+    # otherwise it's fetched from the userinfo endpoint
+    if claims is not None and 'name' in claims and 'email' in claims:
+        data = claims
+    else:
+        data = google.userinfo(access_token)
 
     login_session['username'] = data['name']
-    login_session['picture'] = data['picture']
+    login_session['picture'] = data.get('picture', '')
     login_session['email'] = data['email']
 
     # email has to be unique - so create a new user if email is not in DB
@@ -302,6 +1321,7 @@ def google_connect():
 
 
 @app.route('/logout')
+@changes_data
 def google_logout():
     access_token = login_session.get('access_token')
     if access_token is None:
@@ -309,11 +1329,9 @@ def google_logout():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    url = 'https://accounts.google.com/o/oauth2/revoke?token={}'.format(
-            login_session['access_token'])
-
-    http = httplib2.Http()
-    result = http.request(url, 'GET')[0]
+    # with OAUTH_REVOKE_WORKERS the token is revoked in the background
+    result = google.submit(google.revoke, access_token)
+    result.add_done_callback(log_revoke_result)
 
     del login_session['access_token']
     del login_session['gplus_id']
@@ -321,15 +1339,19 @@ def google_logout():
     del login_session['email']
     del login_session['picture']
 
-    if result['status'] != '200':
-        response = make_response(
-                json.dumps('Failed to revoke token for given user.'))
-        response.headers['Content-Type'] = 'application/json'
-        response.headers['Content-Type'] = 'application/json'
-
     return redirect(url_for('login_view'))
 
 
+def log_revoke_result(result):
+    """
+    Logs failed revocation of the access token on logout.
+
+    :param result: Future of GoogleClient.revoke
+    """
+    if result.exception() is not None or not result.result():
+        app.logger.warning('Failed to revoke token for given user.')
+
+
 ##
 # CATEGORY VIEWS
 ##
@@ -337,8 +1359,11 @@ def google_logout():
 
 @app.route('/')
 @login_protected
+@response_cache.cached(lambda: ['categories'])
+@query_budget(1)
 def category_view():
-    categories = session.query(Category).all()
+    # templates use columns only - any relationship lazy load would be N+1
+    categories = session.query(Category).options(raiseload('*')).all()
     return render_template('view_category.html', categories=categories)
 
 
@@ -354,16 +1379,14 @@ def category_add():
         picture = request.files['category-pic']
 
         if picture and allowed_file(picture.filename):
-            filename = secure_filename(picture.filename)
-            extension = os.path.splitext(filename)[1]
-            unique_filename = str(uuid.uuid4()) + str(extension)
-            picture.save(
-                    os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
+            unique_filename = save_picture(picture)
             new_category.picture = unique_filename
 
         session.add(new_category)
         session.commit()
 
+        invalidate_category(new_category.id)
+
         return redirect(url_for('category_view'))
 
     else:
@@ -394,22 +1417,21 @@ def category_edit(category_id):
         edited_category.description = request.form['description']
 
         picture = request.files['category-pic']
+        old_picture = None
 
         if picture and allowed_file(picture.filename):
-            filename = secure_filename(picture.filename)
-            extension = os.path.splitext(filename)[1]
-
-            unique_filename = str(uuid.uuid4()) + str(extension)
-            picture.save(
-                    os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
-
-            delete_picture(edited_category.picture)
+            unique_filename = save_picture(picture)
 
+            old_picture = edited_category.picture
             edited_category.picture = unique_filename
 
+        delete_picture(old_picture)
+
         session.add(edited_category)
         session.commit()
 
+        invalidate_category(category_id)
+
         return redirect(url_for('category_view'))
 
     else:
@@ -417,6 +1439,7 @@ def category_edit(category_id):
 
 
 @app.route('/category/<int:category_id>/delete/')
+@changes_data
 @login_protected
 def category_delete(category_id):
     try:
@@ -432,18 +1455,15 @@ def category_delete(category_id):
               .format(category_id))
         return redirect(url_for("category_view"))
 
-    items = session.query(Item).filter_by(category_id=deleted_category.id).all()
-
-    # delete all pictures - for items in category and for category
-    for item in items:
-        delete_picture(item.picture)
-        session.delete(item)
-
+    # delete all items and pictures - for items in category and for category
+    delete_category_items(deleted_category.id)
     delete_picture(deleted_category.picture)
 
     session.delete(deleted_category)
     session.commit()
 
+    invalidate_category(category_id, with_items=True)
+
     return redirect(url_for('category_view'))
 
 
@@ -454,15 +1474,27 @@ def category_delete(category_id):
 
 @app.route('/category/<int:category_id>/')
 @login_protected
+@response_cache.cached(lambda category_id: ['category:{}'.format(category_id)])
+@query_budget(2)
 def item_view(category_id):
     try:
         category = session.query(Category).filter_by(id=category_id).one()
     except NoResultFound:
         return render_template("404.html")
 
-    items = session.query(Item).filter_by(category_id=category_id).all()
+    # invalid filters are ignored - the page shows all items
+    min_price, max_price, by_price, after_price = \
+        get_price_args() or (None, None, False, -1)
+
+    query = filter_by_price(session.query(Item).options(raiseload('*'))
+                            .filter_by(category_id=category_id),
+                            min_price, max_price, by_price)
+    if by_price:
+        query = order_by_price(query)
 
-    return render_template('view_item.html', category=category, items=items)
+    return render_template('view_item.html', category=category,
+                           items=query.all(), min_price=min_price,
+                           max_price=max_price, by_price=by_price)
 
 
 @app.route('/item/add/', methods=['GET', 'POST'])
@@ -470,9 +1502,13 @@ def item_view(category_id):
 @login_protected
 def item_add(category_id=1):
     if request.method == 'POST':
+        price = parse_price(request.form['price'])
+        if price is None:
+            flash("Invalid price: {}.".format(request.form['price']))
+            return redirect(request.url)
 
         new_item = Item(name=request.form['name'],
-                        price=request.form['price'],
+                        price_cents=price,
                         description=request.form['description'],
                         category_id=request.form['category-id'],
                         user_id=login_session['user_id'])
@@ -480,16 +1516,14 @@ def item_add(category_id=1):
         picture = request.files['profile-pic']
 
         if picture and allowed_file(picture.filename):
-            filename = secure_filename(picture.filename)
-            extension = os.path.splitext(filename)[1]
-            unique_filename = str(uuid.uuid4()) + str(extension)
-            picture.save(
-                    os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
+            unique_filename = save_picture(picture)
             new_item.picture = unique_filename
 
         session.add(new_item)
         session.commit()
 
+        invalidate_item(new_item.id, request.form['category-id'])
+
         return redirect(
                 url_for('item_view', category_id=request.form['category-id']))
 
@@ -519,28 +1553,35 @@ def item_edit(category_id, item_id):
         return redirect(url_for('item_view', category_id=category_id))
 
     if request.method == 'POST':
+        price = parse_price(request.form['price'])
+        if price is None:
+            flash("Invalid price: {}.".format(request.form['price']))
+            return redirect(request.url)
+
+        # item may be moved - listing of the old category changes too
+        invalidate_item(item_id, category_id)
 
         edited_item.name = request.form['name']
-        edited_item.price = request.form['price']
+        edited_item.price_cents = price
         edited_item.description = request.form['description']
         edited_item.category_id = request.form['category-id']
 
         file = request.files['profile-pic']
+        old_picture = None
 
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            extension = os.path.splitext(filename)[1]
-
-            unique_filename = str(uuid.uuid4()) + str(extension)
-            file.save(
-                    os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
+            unique_filename = save_picture(file)
 
-            delete_picture(edited_item.picture)
+            old_picture = edited_item.picture
             edited_item.picture = unique_filename
 
+        delete_picture(old_picture)
+
         session.add(edited_item)
         session.commit()
 
+        invalidate_item(item_id, request.form['category-id'])
+
         return redirect(
                 url_for('item_view', category_id=request.form['category-id']))
 
@@ -551,6 +1592,7 @@ def item_edit(category_id, item_id):
 
 
 @app.route('/category/<category_id>/item/<item_id>/delete/')
+@changes_data
 @login_protected
 def item_delete(category_id, item_id):
     try:
@@ -572,36 +1614,376 @@ def item_delete(category_id, item_id):
         session.delete(deleted_item)
         session.commit()
 
+        invalidate_item(item_id, category_id)
+
     return redirect(url_for('item_view', category_id=category_id))
 
 
+##
+# SEARCH VIEWS
+##
+
+
+@app.route('/search')
+@login_protected
+def search_view():
+    query, page, results, has_next = search_page(SEARCH_PAGE_SIZE)
+
+    return render_template('search.html', query=query, page=page,
+                           results=results, has_next=has_next)
+
+
 ##
 # API HANDLERS
 ##
 
 @app.route("/api/v1/categories/")
 @auth.login_required
+@conditional(categories_versions)
+@response_cache.cached(lambda: ['categories'])
+@query_budget(2)
 def categories_api():
     """
-    Gets list of all categories - similar to category_view
-    :return: JSON list of all categories
+    Gets list of categories - similar to category_view. The list is paginated
+    with ?after_id=&limit= or streamed whole with ?stream=1, ?fields= selects
+    fields of the categories.
+
+    :return: JSON list of categories and URL of the next page
     """
-    categories = session.query(Category).all()
+    page_args = get_page_args()
+    if page_args is None:
+        return api_error("Invalid pagination arguments.")
+    after_id, limit = page_args
+
+    fields = CATEGORY_SCHEMA.parse_fields(request.args.get('fields'))
+    if fields is None:
+        return api_error("Unknown field in the fields argument.")
+
+    serializer = CATEGORY_SCHEMA.serializer(fields, keys=[Category.id])
+    query = session.query(*serializer.columns)
+
+    if wants_stream():
+        return stream_json({}, 'categories', query.filter(
+                Category.id > after_id).order_by(Category.id), serializer)
+
+    categories, next_after_id = paginate(query, Category, after_id, limit)
+
+    return json_response({
+        "categories": [serializer(row) for row in categories],
+        "next": next_page_url(next_after_id, limit,
+                              fields=request.args.get('fields'))
+    })
+
+
+@app.route("/api/v1/search")
+@auth.login_required
+def search_api():
+    """
+    Full-text search over names and descriptions of items and categories.
+    Results are ranked by relevance, ?page= selects the page.
+
+    :return: JSON list of matching items and categories
+    """
+    query, page, results, has_next = search_page(SEARCH_PAGE_SIZE)
 
     json_data = []
-    for category in categories:
-        json_data.append(category.serialize)
+    for result in results:
+        json_data.append({
+            'type': result.kind,
+            'id': result.id,
+            'category_id': result.category_id,
+            'name': result.name,
+            'description': result.description
+        })
+
+    next_url = None
+    if has_next:
+        next_url = url_for('search_api', q=query, page=page + 1)
+
+    return jsonify(results=json_data, next=next_url)
+
+
+@app.route("/api/v1/bulk", methods=['POST'])
+@auth.login_required
+def bulk_api():
+    """
+    Imports categories and items in batches. Body is NDJSON (one record per
+    line) or CSV (Content-Type: text/csv) with a header. Every record has a
+    'type' ('category' or 'item') and model fields. Categories may set their
+    'id', so items from the same import can refer to them by 'category_id'.
+
+    :return: JSON with numbers of inserted records and per-line errors
+    """
+    if request.mimetype == 'text/csv':
+        records = read_csv(request.stream)
+    else:
+        records = read_ndjson(request.stream)
+
+    bulk_import = BulkImport(session, g.user_id, BULK_BATCH_SIZE,
+                             app.config['UPLOAD_FOLDER'])
+    for number, row in records:
+        bulk_import.add(number, row)
+    bulk_import.flush()
+
+    response_cache.invalidate('categories', *[
+        'category:{}'.format(category_id)
+        for category_id in bulk_import.category_ids])
+
+    return jsonify(bulk_import.report)
+
+
+@app.route("/api/v1/export")
+@auth.login_required
+def export_api():
+    """
+    Streams the whole catalogue as NDJSON in the format accepted by
+    /api/v1/bulk.
+
+    :return: Streamed NDJSON response
+    """
+    return Response(stream_with_context(export_ndjson(session,
+                                                      API_STREAM_BATCH)),
+                    mimetype='application/x-ndjson')
+
+
+def get_batch_ids():
+    """
+    Reads {"ids": [...]} body of a batch request.
+
+    :return: tuple (list of ids, error message)
+    """
+    request_json = request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+        return None, "Expected JSON object with 'ids'."
+
+    return read_ids(request_json.get('ids'), API_BATCH_MAX_SIZE)
+
+
+@app.route("/api/v1/items:batchGet", methods=['POST'])
+@auth.login_required
+@query_budget(1)
+def items_batch_get_api():
+    """
+    Gets many items by their ids ({"ids": [1, 2, ...]}) with a single query.
+    ?fields= selects fields of the items.
+
+    :return: JSON list of per-id results in the order of the ids - the item
+             or an error
+    """
+    item_ids, error = get_batch_ids()
+    if error:
+        return api_error(error)
+
+    fields = ITEM_SCHEMA.parse_fields(request.args.get('fields'))
+    if fields is None:
+        return api_error("Unknown field in the fields argument.")
+
+    serializer = ITEM_SCHEMA.serializer(fields, keys=[Item.id])
+    items = {row.id: serializer(row) for row in session.execute(
+            select(serializer.columns).where(Item.id.in_(item_ids)))}
+
+    results = []
+    for item_id in item_ids:
+        if item_id in items:
+            results.append({'id': item_id, 'ok': True,
+                            'item': items[item_id]})
+        else:
+            results.append({'id': item_id, 'ok': False,
+                            'error': "There is no item with id: {}.".format(
+                                    item_id)})
+
+    return json_response({"results": results})
+
+
+@app.route("/api/v1/items:batchUpdate", methods=['POST'])
+@auth.login_required
+# items, categories, the change version, one UPDATE per combination of
+# patched fields and item counts
+@query_budget(5 + 2 ** 4)
+def items_batch_update_api():
+    """
+    Modifies many items in one transaction. Body is {"items": [{"id": 1,
+    "name": ..., "price": ..., "description": ..., "category_id": ...}, ...]}
+    - every patch sets only the fields it contains. Invalid patches and
+    missing items are reported, the rest is applied.
+
+    :return: JSON list of per-patch results in the order of the patches
+    """
+    request_json = request.get_json(silent=True)
+    patches = request_json.get('items') \
+        if isinstance(request_json, dict) else None
+
+    if not isinstance(patches, list) or not patches:
+        return api_error("Expected JSON object with a non-empty list "
+                         "'items'.")
+    if len(patches) > API_BATCH_MAX_SIZE:
+        return api_error("At most {} items are allowed in one request."
+                         .format(API_BATCH_MAX_SIZE))
+
+    results, changed = update_items(session, patches)
+
+    tags = {'categories'}
+    for item_id, old_category_id, new_category_id in changed:
+        tags.update(['item:{}'.format(item_id),
+                     'category:{}'.format(old_category_id),
+                     'category:{}'.format(new_category_id)])
+    response_cache.invalidate(*tags)
+
+    return jsonify(results=results)
+
 
-    return jsonify(categories=json_data)
+@app.route("/api/v1/items:batchDelete", methods=['POST'])
+@auth.login_required
+@query_budget(7)
+def items_batch_delete_api():
+    """
+    Deletes many items ({"ids": [1, 2, ...]}) in one transaction.
+
+    :return: JSON list of per-id results in the order of the ids
+    """
+    item_ids, error = get_batch_ids()
+    if error:
+        return api_error(error)
+
+    categories = dict(session.query(Item.id, Item.category_id)
+                      .filter(Item.id.in_(item_ids)))
+
+    if categories:
+        delete_items(categories)
+        session.commit()
+
+    tags = {'categories'}
+    results = []
+    for item_id in item_ids:
+        if item_id in categories:
+            tags.update(['item:{}'.format(item_id),
+                         'category:{}'.format(categories[item_id])])
+            results.append({'id': item_id, 'ok': True})
+        else:
+            results.append({'id': item_id, 'ok': False,
+                            'error': "There is no item with id: {}.".format(
+                                    item_id)})
+    response_cache.invalidate(*tags)
+
+    return jsonify(results=results)
+
+
+def get_changes_page(cursor, limit):
+    """
+    Reads a page of changes after the cursor and releases the connection,
+    so a waiting request doesn't hold it (or an old snapshot of the DB).
+
+    :return: tuple (list of serialized changes, cursor, has_more)
+    """
+    changes, cursor, has_more = read_changes(session, cursor, limit)
+    changes = [(key, serialize_change(record)) for key, record in changes]
+    session.close()
+
+    return changes, cursor, has_more
+
+
+def stream_changes(cursor, limit):
+    """
+    Sends changes as server-sent events, each with it's cursor as the event
+    id. The stream waits for new changes and is closed after
+    CHANGES_STREAM_TIMEOUT, the client reconnects with Last-Event-ID.
+
+    :return: Streamed Response
+    """
+
+    def generate():
+        deadline = time.time() + CHANGES_STREAM_TIMEOUT
+        last_sent = time.time()
+        current = cursor
+
+        while time.time() < deadline:
+            seen = change_notifier.version
+            changes, current, has_more = get_changes_page(current, limit)
+
+            for key, change in changes:
+                yield 'id: {}\ndata: {}\n\n'.format(
+                        format_cursor(key), dumps(change).decode('utf-8'))
+                last_sent = time.time()
+
+            if has_more:
+                continue
+
+            if time.time() - last_sent >= CHANGES_KEEPALIVE:
+                # comment line keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                last_sent = time.time()
+
+            change_notifier.wait(seen, CHANGES_POLL_INTERVAL)
+
+    response = Response(stream_with_context(generate()),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route("/api/v1/changes")
+@auth.login_required
+def changes_api():
+    """
+    Feed of categories and items created, modified or deleted after the
+    ?since= cursor (all records without it), ordered by version. With
+    ?wait=<seconds> the request waits until there is a change (long-poll),
+    with 'Accept: text/event-stream' changes are streamed as server-sent
+    events.
+
+    :return: JSON list of changes, cursor of the last one and URL of the next
+             page
+    """
+    cursor = parse_cursor(request.headers.get('Last-Event-ID') or
+                          request.args.get('since'))
+    if cursor is None:
+        return api_error("Invalid cursor.")
+
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return api_error("Invalid limit or wait argument.")
+
+    if limit < 1:
+        return api_error("Invalid limit or wait argument.")
+    limit = min(limit, API_MAX_PAGE_SIZE)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return stream_changes(cursor, limit)
+
+    deadline = time.time() + min(max(wait, 0), CHANGES_MAX_WAIT)
+    while True:
+        seen = change_notifier.version
+        changes, cursor, has_more = get_changes_page(cursor, limit)
+
+        remaining = deadline - time.time()
+        if changes or remaining <= 0:
+            break
+
+        change_notifier.wait(seen, min(remaining, CHANGES_POLL_INTERVAL))
+
+    return json_response({
+        "changes": [change for key, change in changes],
+        "cursor": format_cursor(cursor),
+        "has_more": has_more,
+        "next": url_for('changes_api', since=format_cursor(cursor),
+                        limit=limit)
+    })
 
 
 @app.route("/api/v1/category/<int:category_id>",
            methods=['GET', 'PUT', 'DELETE'])
 @auth.login_required
+@conditional(category_versions)
+@response_cache.cached(lambda category_id: ['category:{}'.format(category_id)])
+@query_budget(10)
 def category_api(category_id):
     """
     Deals with all category (single category) endpoints.
-    GET - gets JSON description of category
+    GET - gets JSON description of category and a page of it's items,
+          filtered with ?min_price=&max_price= and ordered with ?sort=price
     PUT - modifies chosen category
     DELETE - deletes chosen category
 
@@ -616,19 +1998,56 @@ def category_api(category_id):
                 category_id))
 
     if request.method == 'GET':
-        items = session.query(Item).filter_by(category_id=category_id).all()
-
-        # building a response json with the category and all it's items
-        items_list = []
-        for item in items:
-            items_list.append(item.serialize)
-
-        json_data = {
-            "category": category.serialize,
-            "items": items_list
-        }
+        page_args = get_page_args()
+        if page_args is None:
+            return api_error("Invalid pagination arguments.")
+        after_id, limit = page_args
+
+        price_args = get_price_args()
+        if price_args is None:
+            return api_error("Invalid price filter or sort order.")
+        min_price, max_price, by_price, after_price = price_args
+
+        fields = ITEM_SCHEMA.parse_fields(request.args.get('fields'))
+        if fields is None:
+            return api_error("Unknown field in the fields argument.")
+
+        # the cursor of the next page is read from the rows
+        serializer = ITEM_SCHEMA.serializer(
+                fields, keys=[Item.id, Item.price_cents] if by_price
+                else [Item.id])
+        query = filter_by_price(session.query(*serializer.columns)
+                                .filter(Item.category_id == category_id),
+                                min_price, max_price, by_price)
+
+        # the next page keeps filters, fields and the order of this one
+        values = {name: request.args[name] for name in
+                  ('min_price', 'max_price', 'sort', 'fields')
+                  if name in request.args}
+
+        if wants_stream():
+            if by_price:
+                query = order_by_price(query, after_price, after_id)
+            else:
+                query = query.filter(Item.id > after_id).order_by(Item.id)
+            return stream_json({"category": CATEGORY_SCHEMA.dump(category)},
+                               'items', query, serializer)
+
+        if by_price:
+            items, cursor = paginate_by_price(query, after_price, after_id,
+                                              limit)
+            next_after_id = None
+            if cursor is not None:
+                values['after_price'], next_after_id = cursor
+        else:
+            items, next_after_id = paginate(query, Item, after_id, limit)
 
-        return jsonify(json_data)
+        return json_response({
+            "category": CATEGORY_SCHEMA.dump(category),
+            "items": [serializer(row) for row in items],
+            "next": next_page_url(next_after_id, limit,
+                                  category_id=category_id, **values)
+        })
 
     if request.method == 'PUT':
         request_json = request.get_json()
@@ -644,22 +2063,21 @@ def category_api(category_id):
         session.add(category)
         session.commit()
 
+        invalidate_category(category_id)
+
         return api_success(
                 "Successfully modified category with id: {}.".format(
                         category_id))
 
     if request.method == 'DELETE':
-        items = session.query(Item).filter_by(category_id=category.id).all()
-
-        for item in items:
-            delete_picture(item.picture)
-            session.delete(item)
-
+        delete_category_items(category.id)
         delete_picture(category.picture)
 
         session.delete(category)
         session.commit()
 
+        invalidate_category(category_id, with_items=True)
+
         return api_success(
                 "Successfully deleted category with id: {} and it's all "
                 "items.".format(category_id))
@@ -668,6 +2086,10 @@ def category_api(category_id):
 @app.route("/api/v1/category/<int:category_id>/item/<int:item_id>",
            methods=['GET', 'PUT', 'DELETE'])
 @auth.login_required
+@conditional(item_versions)
+@response_cache.cached(lambda category_id, item_id: [
+    'item:{}'.format(item_id), 'category-items:{}'.format(category_id)])
+@query_budget(8)
 def item_api(category_id, item_id):
     """
     Deals with all item (single item) endpoints.
@@ -689,17 +2111,23 @@ def item_api(category_id, item_id):
                         item_id, category_id))
 
     if request.method == 'GET':
-        return jsonify(item=item.serialize)
+        fields = ITEM_SCHEMA.parse_fields(request.args.get('fields'))
+        if fields is None:
+            return api_error("Unknown field in the fields argument.")
+
+        return json_response({"item": ITEM_SCHEMA.dump(item, fields)})
 
     if request.method == 'DELETE':
         delete_picture(item.picture)
 
         session.delete(item)
         session.commit()
+
+        invalidate_item(item_id, category_id)
+
         return api_success(
                 "Successfully deleted item with id: {} from category id: {"
-                "}.").format(
-                item_id, category_id)
+                "}.".format(item_id, category_id))
 
     if request.method == 'PUT':
         request_json = request.get_json()
@@ -712,19 +2140,27 @@ def item_api(category_id, item_id):
         if 'description' in request_json:
             item.description = request_json['description']
         if 'price' in request_json:
-            item.description = request_json['price']
+            # null removes the price
+            price = request_json['price']
+            if price is not None:
+                price = parse_price(price)
+                if price is None:
+                    return api_error("Invalid price: {}.".format(
+                            json.dumps(request_json['price'])))
+            item.price_cents = price
 
         session.add(item)
         session.commit()
 
+        invalidate_item(item_id, category_id)
+
         return api_success(
                 "Successfully modified item with id: {} "
                 "from category id: {}.".format(item_id, category_id))
 
 
 if __name__ == "__main__":
-    # Note - for a production env change secret_key to a unique string and
-    # debug to False!
-    app.secret_key = "this_is_my_secret"
+    create_app({'DATABASE_MIGRATE': True})
+    # Note - for a production env change debug to False!
     app.debug = True
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,382 @@
+"""
+Load test and benchmark of the catalogue views and API endpoints.
+
+Seed a synthetic catalogue (a separate database file):
+
+    python3 benchmark.py seed bench.db --users 10 --categories 100 --items 100
+
+Run the benchmark through the Flask test client or a real threaded WSGI
+server, optionally saving the results as a baseline or comparing with one:
+
+    python3 benchmark.py run bench.db --requests 500
+    python3 benchmark.py run bench.db --server --concurrency 8
+    python3 benchmark.py run bench.db --save-baseline baseline.json
+    python3 benchmark.py run bench.db --baseline baseline.json
+
+Google Sign-In is not needed - the benchmark signs in by writing the login
+session to the session store directly and generates API tokens itself.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import resource
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+##
+# SEEDING
+##
+
+
+def seed(path, users, categories, items, batch_size=10000):
+    """
+    Creates a new database with a synthetic catalogue.
+
+    :param path: Path of the database file
+    :param users: Number of users
+    :param categories: Number of categories (in total)
+    :param items: Number of items in every category
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    from database import create_db_engine
+    from migrations import count_category_items, migrate
+    from model import Category, Item, User
+    engine = create_db_engine('sqlite:///' + path)
+    migrate(engine)
+
+    words = ['red', 'green', 'blue', 'old', 'new', 'small', 'big', 'fast',
+             'game', 'movie', 'song', 'book', 'brick', 'food', 'tool']
+
+    def text(count):
+        return ' '.join(random.choice(words) for x in range(count))
+
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'id': user_id, 'username': 'user{}'.format(user_id),
+             'email': 'user{}@example.com'.format(user_id), 'picture': ''}
+            for user_id in range(1, users + 1)])
+
+        connection.execute(Category.__table__.insert(), [
+            {'id': category_id, 'name': text(2), 'description': text(8),
+             'user_id': random.randint(1, users)}
+            for category_id in range(1, categories + 1)])
+
+        batch = []
+        for category_id in range(1, categories + 1):
+            for x in range(items):
+                batch.append({'name': text(3), 'description': text(12),
+                              'price_cents': random.randint(0, 10000),
+                              'category_id': category_id,
+                              'user_id': random.randint(1, users)})
+                if len(batch) >= batch_size:
+                    connection.execute(Item.__table__.insert(), batch)
+                    batch = []
+        if batch:
+            connection.execute(Item.__table__.insert(), batch)
+
+        count_category_items(connection)
+
+    print("Seeded '{}': {} users, {} categories, {} items.".format(
+            path, users, categories, categories * items))
+
+
+##
+# BENCHMARK
+##
+
+SCENARIOS = ['category_view', 'item_view', 'categories_api', 'category_api',
+             'item_api']
+
+
+class Benchmark(object):
+    """
+    Drives the views with generated requests and collects latencies, SQL
+    query counts and memory usage.
+    """
+
+    def __init__(self, app_module, server=False, concurrency=1):
+        self.app_module = app_module
+        self.app = app_module.app
+        self.server = server
+        self.concurrency = concurrency
+
+        self.queries = 0
+        self.queries_lock = threading.Lock()
+
+        app_module.db.listen('before_cursor_execute', self.count_query)
+
+        from model import Category, Item, User
+        session = app_module.DBSession()
+        self.user = session.query(User).first()
+        self.category_ids = [category_id for category_id,
+                             in session.query(Category.id)]
+        self.items = session.query(Item.category_id, Item.id) \
+            .order_by(Item.id).limit(10000).all()
+        session.close()
+
+        with self.app.app_context():
+            token = self.user.generate_auth_token(3600)
+        if isinstance(token, bytes):
+            token = token.decode('ascii')
+        self.api_headers = {'Authorization': 'Basic ' + base64.b64encode(
+                (token + ':').encode('ascii')).decode('ascii')}
+
+        login = {'username': self.user.username, 'email': self.user.email,
+                 'picture': self.user.picture, 'user_id': self.user.id}
+        # sessions are kept on the server - the login session is written to
+        # the (in-memory) session store and the cookie carries its id
+        interface = self.app.session_interface
+        self.cookie = secrets.token_urlsafe(32)
+        interface.store.set(self.cookie, interface.serializer.dumps(
+                {'saved_at': time.time(), 'data': login}), interface.ttl)
+        self.cookie_name = self.app.session_cookie_name
+
+    def count_query(self, *args):
+        with self.queries_lock:
+            self.queries += 1
+
+    def make_request(self, scenario):
+        """
+        :return: tuple (path, headers) of a random request of the scenario
+        """
+        category_id = random.choice(self.category_ids)
+        category_id_item, item_id = random.choice(self.items)
+
+        if scenario == 'category_view':
+            return '/', {}
+        if scenario == 'item_view':
+            return '/category/{}/'.format(category_id), {}
+        if scenario == 'categories_api':
+            return '/api/v1/categories/', self.api_headers
+        if scenario == 'category_api':
+            return '/api/v1/category/{}'.format(category_id), self.api_headers
+        return '/api/v1/category/{}/item/{}'.format(
+                category_id_item, item_id), self.api_headers
+
+    def run(self, scenarios, requests_count):
+        results = {}
+
+        if self.server:
+            from werkzeug.serving import WSGIRequestHandler, make_server
+
+            class QuietHandler(WSGIRequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+
+            httpd = make_server('127.0.0.1', 0, self.app, threaded=True,
+                                request_handler=QuietHandler)
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.daemon = True
+            thread.start()
+            base_url = 'http://127.0.0.1:{}'.format(httpd.server_port)
+
+        try:
+            for scenario in scenarios:
+                if self.server:
+                    send = self.http_sender(base_url)
+                else:
+                    send = self.test_client_sender()
+
+                results[scenario] = self.run_scenario(scenario, send,
+                                                      requests_count)
+        finally:
+            if self.server:
+                httpd.shutdown()
+
+        results['peak_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        return results
+
+    def test_client_sender(self):
+        local = threading.local()
+
+        def send(path, headers):
+            if not hasattr(local, 'client'):
+                local.client = self.app.test_client()
+                local.client.set_cookie('localhost', self.cookie_name,
+                                        self.cookie)
+            return local.client.get(path, headers=headers).status_code
+
+        return send
+
+    def http_sender(self, base_url):
+        import requests
+        local = threading.local()
+
+        def send(path, headers):
+            if not hasattr(local, 'http'):
+                local.http = requests.Session()
+                local.http.cookies.set(self.cookie_name, self.cookie)
+            return local.http.get(base_url + path,
+                                  headers=headers).status_code
+
+        return send
+
+    def run_scenario(self, scenario, send, requests_count):
+        requests = [self.make_request(scenario)
+                    for x in range(requests_count)]
+        latencies = []
+        statuses = []
+
+        def timed(request):
+            start = time.perf_counter()
+            statuses.append(send(*request))
+            latencies.append(time.perf_counter() - start)
+
+        self.queries = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(timed, requests))
+        duration = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            'requests': requests_count,
+            'errors': sum(1 for status in statuses if status != 200),
+            'throughput_rps': requests_count / duration,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_request': self.queries / float(requests_count)
+        }
+
+
+def percentile(values, percent):
+    """
+    :param values: Sorted list of values
+    :return: Value of the percentile (nearest rank)
+    """
+    if not values:
+        return 0
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+##
+# REPORTING
+##
+
+# Metrics where the higher value is better
+HIGHER_IS_BETTER = {'throughput_rps'}
+
+
+def print_results(results, baseline=None, threshold=0.2):
+    """
+    Prints results, compared with the baseline if given.
+
+    :return: list of regressions larger than threshold
+    """
+    regressions = []
+    print('{:<16} {:>10} {:>9} {:>9} {:>9} {:>8} {:>7}'.format(
+            'scenario', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'queries',
+            'errors'))
+
+    for scenario in SCENARIOS:
+        if scenario not in results:
+            continue
+        result = results[scenario]
+        print('{:<16} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f} {:>7}'
+              .format(scenario, result['throughput_rps'], result['p50_ms'],
+                      result['p95_ms'], result['p99_ms'],
+                      result['queries_per_request'], result['errors']))
+
+        if baseline is None or scenario not in baseline:
+            continue
+
+        changes = []
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms',
+                       'queries_per_request'):
+            old, new = baseline[scenario][metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            changes.append('{} {:+.0%}'.format(metric, change))
+
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > threshold:
+                regressions.append('{} {}: {:.2f} -> {:.2f}'.format(
+                        scenario, metric, old, new))
+
+        print('{:<16} {}'.format('  vs baseline', ', '.join(changes)))
+
+    print('peak RSS: {} KB'.format(results['peak_rss_kb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+
+    seed_parser = commands.add_parser('seed', help='create synthetic data')
+    seed_parser.add_argument('database')
+    seed_parser.add_argument('--users', type=int, default=10)
+    seed_parser.add_argument('--categories', type=int, default=100)
+    seed_parser.add_argument('--items', type=int, default=100,
+                             help='items in every category')
+
+    run_parser = commands.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('database')
+    run_parser.add_argument('--scenario', action='append',
+                            choices=SCENARIOS)
+    run_parser.add_argument('--requests', type=int, default=200,
+                            help='requests per scenario')
+    run_parser.add_argument('--concurrency', type=int, default=1)
+    run_parser.add_argument('--server', action='store_true',
+                            help='use a real WSGI server')
+    run_parser.add_argument('--no-cache', action='store_true',
+                            help='disable the response and fragment caches')
+    run_parser.add_argument('--save-baseline')
+    run_parser.add_argument('--baseline')
+    run_parser.add_argument('--threshold', type=float, default=0.2,
+                            help='allowed regression (0.2 = 20%%)')
+
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed(args.database, args.users, args.categories, args.items)
+        return 0
+
+    if args.command != 'run':
+        parser.print_help()
+        return 1
+
+    import app as app_module
+    # the benchmark's login session must not end up in the app's sessions.db
+    app_module.create_app({'DATABASE_URL': 'sqlite:///' + args.database,
+                           'SESSION_STORE': 'memory'})
+    app_module.response_cache.enabled = not args.no_cache
+    if args.no_cache:
+        app_module.app.jinja_env.fragment_cache = None
+
+    benchmark = Benchmark(app_module, args.server, args.concurrency)
+    results = benchmark.run(args.scenario or SCENARIOS, args.requests)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = print_results(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if regressions:
+        print('Regressions:')
+        for regression in regressions:
+            print('  ' + regression)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
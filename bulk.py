@@ -0,0 +1,480 @@
+import codecs
+import csv
+import json
+import os
+from collections import Counter
+
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from changes import count_items, stamp
+from model import Category, Item, format_price, parse_price
+from uploads import is_upload_name
+
+##
+# BULK IMPORT
+##
+
+CATEGORY_FIELDS = ('id', 'name', 'description', 'picture')
+ITEM_FIELDS = ('id', 'name', 'price', 'description', 'picture',
+               'category_id')
+# Fields stored in a column of another name - the price is imported and
+# exported in major units ('12.50') and stored in minor units
+FIELD_COLUMNS = {'price': 'price_cents'}
+
+
+def read_ndjson(stream):
+    """
+    Reads records from NDJSON stream (one JSON object per line) without
+    loading the whole body into memory.
+
+    :param stream: Binary stream (e.g. request.stream)
+    :return: generator of (line number, record or None if line is invalid)
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield number, None
+            continue
+
+        yield number, record if isinstance(record, dict) else None
+
+
+def read_csv(stream):
+    """
+    Reads records from CSV stream. The first line is a header with column
+    names ('type', 'id', 'name', ...).
+
+    :param stream: Binary stream (e.g. request.stream)
+    :return: generator of (line number, record)
+    """
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
+
+    for record in reader:
+        # empty CSV cells mean "no value"
+        yield reader.line_num, {key: value for key, value in record.items()
+                                if value != ''}
+
+
+def validate(record, fields):
+    """
+    Builds a row for INSERT from the imported record.
+
+    :return: tuple (row, error message)
+    """
+    row = {field: record.get(field) for field in fields}
+
+    if not row['name'] or not isinstance(row['name'], str):
+        return None, "Missing name."
+    if len(row['name']) > 80:
+        return None, "Name is longer than 80 characters."
+
+    for field in ('id', 'category_id'):
+        if row.get(field) is not None:
+            try:
+                row[field] = int(row[field])
+            except (TypeError, ValueError):
+                return None, "Invalid {}.".format(field)
+
+    if 'price' in row:
+        price = row.pop('price')
+        row['price_cents'] = price if price is None else parse_price(price)
+        if price is not None and row['price_cents'] is None:
+            return None, "Invalid price."
+
+    # deleting the record deletes the picture file - only names of stored
+    # uploads are accepted, never paths
+    if row.get('picture') is not None and not is_upload_name(row['picture']):
+        return None, "Invalid picture."
+
+    if row['id'] is None:
+        # let the DB assign the id
+        del row['id']
+
+    return row, None
+
+
+class BulkImport(object):
+    """
+    Inserts imported categories and items in batches. Every batch is a single
+    executemany INSERT in it's own transaction. If a batch fails, it's rows
+    are inserted one by one, so only the bad rows are reported.
+    """
+
+    def __init__(self, session, user_id, batch_size=1000,
+                 upload_folder=None):
+        """
+        :param upload_folder: Folder with uploaded files - imported pictures
+                              have to be there, None skips the check
+        """
+        self.session = session
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.upload_folder = upload_folder
+
+        self.pending = {Category: [], Item: []}
+        self.inserted = {Category: 0, Item: 0}
+        self.category_ids = set()
+        self.errors = []
+
+    def add(self, number, record):
+        """
+        Validates the record and queues it for insertion.
+
+        :param number: Line number - used in the error report
+        :param record: dict with 'type' and model fields
+        """
+        if record is None:
+            self.errors.append({'line': number, 'error': "Invalid record."})
+            return
+
+        kind = record.get('type')
+        if kind == 'category':
+            model, fields = Category, CATEGORY_FIELDS
+        elif kind == 'item':
+            model, fields = Item, ITEM_FIELDS
+        else:
+            self.errors.append({'line': number,
+                                'error': "Unknown type: {}.".format(kind)})
+            return
+
+        row, error = validate(record, fields)
+        if error:
+            self.errors.append({'line': number, 'error': error})
+            return
+
+        if row.get('picture') and self.upload_folder is not None and \
+                not os.path.isfile(os.path.join(self.upload_folder,
+                                                row['picture'])):
+            self.errors.append({'line': number,
+                                'error': "There is no uploaded picture: "
+                                         "{}.".format(row['picture'])})
+            return
+
+        if model is Item and row['category_id'] is None:
+            self.errors.append({'line': number,
+                                'error': "Missing category_id."})
+            return
+
+        row['user_id'] = self.user_id
+        self.pending[model].append((number, row))
+
+        if len(self.pending[model]) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model=None):
+        """
+        Inserts queued rows. Categories are always inserted before items,
+        so items may refer to categories from the same import.
+
+        :param model: Category or Item, None flushes both
+        """
+        self._insert(Category)
+        if model is not Category:
+            self._insert(Item)
+
+    def _insert(self, model):
+        batch = self.pending[model]
+        self.pending[model] = []
+        if not batch:
+            return
+
+        if model is Item:
+            batch = self._check_categories(batch)
+
+        # executemany needs the same columns in every row - rows with and
+        # without explicit id are inserted separately
+        with_id = [(number, row) for number, row in batch if 'id' in row]
+        without_id = [(number, row) for number, row in batch
+                      if 'id' not in row]
+
+        for rows in (with_id, without_id):
+            if rows:
+                self._insert_rows(model, rows)
+
+    def _insert_rows(self, model, batch):
+        try:
+            self.session.execute(model.__table__.insert(),
+                                 stamp(self.session,
+                                       [row for number, row in batch]))
+            self._count(model, [row for number, row in batch])
+            self.session.commit()
+            self.inserted[model] += len(batch)
+            self._touch(model, [row for number, row in batch])
+
+        except SQLAlchemyError:
+            self.session.rollback()
+
+            for number, row in batch:
+                try:
+                    self.session.execute(model.__table__.insert(),
+                                         stamp(self.session, [row])[0])
+                    self._count(model, [row])
+                    self.session.commit()
+                    self.inserted[model] += 1
+                    self._touch(model, [row])
+
+                except SQLAlchemyError as e:
+                    self.session.rollback()
+                    self.errors.append({
+                        'line': number,
+                        'error': str(getattr(e, 'orig', None) or e)})
+
+    def _check_categories(self, batch):
+        """
+        Drops items referring to categories that don't exist - a single
+        query checks all categories used by the batch.
+        """
+        used_ids = {row['category_id'] for number, row in batch}
+        existing_ids = {category_id for category_id, in self.session.query(
+                Category.id).filter(Category.id.in_(used_ids))}
+
+        valid = []
+        for number, row in batch:
+            if row['category_id'] in existing_ids:
+                valid.append((number, row))
+            else:
+                self.errors.append({
+                    'line': number,
+                    'error': "There is no category with id: {}.".format(
+                            row['category_id'])})
+
+        return valid
+
+    def _count(self, model, rows):
+        """
+        Adds inserted items to item counts of their categories.
+        """
+        if model is Item:
+            count_items(self.session, Counter(row['category_id']
+                                              for row in rows))
+
+    def _touch(self, model, rows):
+        """
+        Remembers categories affected by the import.
+        """
+        for row in rows:
+            if model is Item:
+                self.category_ids.add(row['category_id'])
+            elif 'id' in row:
+                self.category_ids.add(row['id'])
+
+    @property
+    def report(self):
+        return {
+            'categories': self.inserted[Category],
+            'items': self.inserted[Item],
+            'errors': sorted(self.errors, key=lambda error: error['line'])
+        }
+
+
+##
+# BATCH UPDATE
+##
+
+# Fields of an item the batch update may change
+ITEM_PATCH_FIELDS = ('name', 'price', 'description', 'category_id')
+
+
+def read_ids(ids, max_size):
+    """
+    Validates list of ids sent to a batch endpoint. Duplicates are dropped,
+    the order is kept.
+
+    :param ids: Decoded JSON value
+    :param max_size: Maximal number of ids in one request
+    :return: tuple (list of ids, error message)
+    """
+    if not isinstance(ids, list) or not ids:
+        return None, "Expected a non-empty list of ids."
+    if len(ids) > max_size:
+        return None, "At most {} ids are allowed in one request.".format(
+                max_size)
+
+    unique = []
+    for item_id in ids:
+        if not isinstance(item_id, int) or isinstance(item_id, bool):
+            return None, "Invalid id: {}.".format(json.dumps(item_id))
+        if item_id not in unique:
+            unique.append(item_id)
+
+    return unique, None
+
+
+def validate_patch(patch):
+    """
+    Builds a row for UPDATE from a patch of the batch update.
+
+    :return: tuple (row, error message)
+    """
+    if not isinstance(patch, dict):
+        return None, "Invalid patch."
+
+    item_id = patch.get('id')
+    if not isinstance(item_id, int) or isinstance(item_id, bool):
+        return None, "Missing id."
+
+    unknown = sorted(set(patch) - set(ITEM_PATCH_FIELDS) - {'id'})
+    if unknown:
+        return None, "Unknown fields: {}.".format(', '.join(unknown))
+
+    row = {field: patch[field] for field in ITEM_PATCH_FIELDS
+           if field in patch}
+    if not row:
+        return None, "Nothing changed - no fields to update."
+
+    if 'name' in row:
+        if not row['name'] or not isinstance(row['name'], str):
+            return None, "Missing name."
+        if len(row['name']) > 80:
+            return None, "Name is longer than 80 characters."
+
+    if 'description' in row and row['description'] is not None:
+        if not isinstance(row['description'], str):
+            return None, "Invalid description."
+        if len(row['description']) > 250:
+            return None, "Description is longer than 250 characters."
+
+    if 'category_id' in row:
+        try:
+            row['category_id'] = int(row['category_id'])
+        except (TypeError, ValueError):
+            return None, "Invalid category_id."
+
+    if 'price' in row:
+        price = row.pop('price')
+        row['price_cents'] = price if price is None else parse_price(price)
+        if price is not None and row['price_cents'] is None:
+            return None, "Invalid price."
+
+    # 'id' can't be a bound parameter of UPDATE ... SET
+    row['item_id'] = item_id
+    return row, None
+
+
+def update_items(session, patches):
+    """
+    Applies patches of many items in a single transaction. Items and the
+    categories they are moved to are looked up with one IN query each and
+    patches changing the same fields are sent as one executemany UPDATE, so
+    the number of statements doesn't depend on the number of items.
+
+    :param session: SQLAlchemy session
+    :param patches: list of dicts with item's 'id' and fields to change
+    :return: tuple (results, changed) - per-patch results in the order of
+             patches and list of (item id, old category id, new category id)
+             of updated items
+    """
+    results = []
+    rows = []
+    for patch in patches:
+        row, error = validate_patch(patch)
+        if error:
+            results.append({'id': patch.get('id') if isinstance(
+                    patch, dict) else None, 'ok': False, 'error': error})
+        else:
+            results.append({'id': row['item_id'], 'ok': True})
+            rows.append((results[-1], row))
+
+    if not rows:
+        return results, []
+
+    categories = dict(session.execute(
+            select([Item.id, Item.category_id])
+            .where(Item.id.in_({row['item_id'] for result, row in rows})))
+            .fetchall())
+
+    used_ids = {row['category_id'] for result, row in rows
+                if 'category_id' in row}
+    existing_ids = set()
+    if used_ids:
+        existing_ids = {category_id for category_id, in session.execute(
+                select([Category.id]).where(Category.id.in_(used_ids)))}
+
+    # patches with the same fields share one UPDATE statement
+    groups = {}
+    changed = []
+    seen = set()
+    for result, row in rows:
+        item_id = row['item_id']
+
+        if item_id not in categories:
+            error = "There is no item with id: {}.".format(item_id)
+        elif item_id in seen:
+            error = "Item with id: {} is patched twice.".format(item_id)
+        elif 'category_id' in row and row['category_id'] not in existing_ids:
+            error = "There is no category with id: {}.".format(
+                    row['category_id'])
+        else:
+            error = None
+
+        if error:
+            result.update(ok=False, error=error)
+            continue
+
+        seen.add(item_id)
+        fields = tuple(sorted(field for field in row if field != 'item_id'))
+        groups.setdefault(fields, []).append(row)
+        changed.append((item_id, categories[item_id],
+                        row.get('category_id', categories[item_id])))
+
+    # moved items change counts of both categories
+    deltas = Counter()
+    for item_id, old_category_id, new_category_id in changed:
+        deltas[old_category_id] += 0
+        if old_category_id != new_category_id:
+            deltas[old_category_id] -= 1
+            deltas[new_category_id] += 1
+
+    try:
+        for fields, group in groups.items():
+            session.execute(Item.__table__.update()
+                            .where(Item.id == bindparam('item_id')),
+                            stamp(session, group))
+        count_items(session, deltas)
+        session.commit()
+
+    except SQLAlchemyError as e:
+        session.rollback()
+        for result in results:
+            if result['ok']:
+                result.update(ok=False,
+                              error=str(getattr(e, 'orig', None) or e))
+        return results, []
+
+    return results, changed
+
+
+##
+# EXPORT
+##
+
+
+def export_ndjson(session, batch_size=1000):
+    """
+    Dumps the whole catalogue as NDJSON - categories first, then items. Rows
+    are read as plain tuples from the DB cursor in batches, so the memory
+    usage doesn't depend on the size of the catalogue.
+
+    :param session: SQLAlchemy session
+    :param batch_size: Number of rows fetched at once
+    :return: generator of NDJSON lines
+    """
+    for kind, model, fields in (('category', Category, CATEGORY_FIELDS),
+                                ('item', Item, ITEM_FIELDS)):
+        columns = [getattr(model, FIELD_COLUMNS.get(field, field))
+                   for field in fields]
+        query = session.query(*columns).order_by(model.id) \
+            .yield_per(batch_size)
+
+        for row in query:
+            record = {'type': kind}
+            record.update(zip(fields, row))
+            if 'price' in record:
+                record['price'] = format_price(record['price'])
+            yield json.dumps(record) + '\n'
@@ -0,0 +1,319 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, g, make_response, request
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+##
+# CACHE BACKENDS
+##
+
+
+class LRUBackend(object):
+    """
+    In-process cache keeping at most max_entries values. The least recently
+    used entries are evicted first. Safe to use from many threads.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if expires is not None and expires < time.time():
+                return None
+
+            # re-insert, so the entry becomes the most recently used one
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SharedBackend(object):
+    """
+    Cache shared by all worker processes. Wraps a memcached or redis style
+    client - any object with get(key), set(key, value, ...) and delete(key).
+
+    e.g. SharedBackend(redis.StrictRedis())
+    """
+
+    def __init__(self, client, prefix='itemapp:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if timeout:
+            self.client.set(self.prefix + key, value, timeout)
+        else:
+            self.client.set(self.prefix + key, value)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+##
+# RESPONSE CACHE
+##
+
+
+class ResponseCache(object):
+    """
+    Caches rendered responses of GET views. Every entry is tagged (e.g. with
+    'category:1') and invalidate() drops only the entries with given tag.
+
+    Tags are versioned - the current version of every tag is a part of the
+    entry key, so invalidating a tag just gives it a new random version and
+    the old entries are never reached again (the backend evicts them later).
+    This works the same way for the in-process and the shared backend.
+    """
+
+    def __init__(self, backend=None, timeout=300, identity=None):
+        """
+        :param backend: LRUBackend (default) or SharedBackend
+        :param timeout: Entry lifetime in seconds. Limits staleness of
+                        in-process caches of other worker processes.
+        :param identity: Function returning id of the authenticated user -
+                         responses are cached separately for every user.
+        """
+        self.backend = backend or LRUBackend()
+        self.timeout = timeout
+        self.identity = identity or (lambda: None)
+        self.enabled = True
+
+    def _tag_version(self, tag):
+        key = 'tag:' + tag
+        version = self.backend.get(key)
+
+        if version is None:
+            version = uuid.uuid4().hex
+            self.backend.set(key, version)
+
+        return version
+
+    def invalidate(self, *tags):
+        """
+        Drops all cached responses tagged with any of given tags.
+
+        :param tags: e.g. 'categories', 'category:1'
+        """
+        for tag in tags:
+            self.backend.set('tag:' + tag, uuid.uuid4().hex)
+
+    def make_key(self, tags):
+        """
+        Builds key of the current request - it consists of the route, it's
+        arguments, the query string, user identity and versions of the tags.
+        """
+        parts = [request.endpoint,
+                 repr(sorted((request.view_args or {}).items())),
+                 request.query_string.decode('latin-1'),
+                 repr(self.identity())]
+        parts.extend(tag + '=' + self._tag_version(tag) for tag in tags)
+
+        return 'response:' + hashlib.sha1(
+                '\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def cached(self, tags):
+        """
+        Decorator caching response of the GET view. Cached responses have
+        ETag and Last-Modified headers, so clients can revalidate them and
+        get '304 Not Modified'.
+
+        :param tags: Function returning a list of tags for view arguments
+        """
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if not self.enabled or request.method != 'GET':
+                    return f(*args, **kwargs)
+
+                key = self.make_key(tags(**kwargs))
+                entry = self.backend.get(key)
+
+                if entry is None:
+                    response = make_response(f(*args, **kwargs))
+
+                    # streamed, failed or explicitly excluded (see
+                    # uncacheable()) responses are not cached
+                    if response.status_code != 200 or response.is_streamed \
+                            or g.get('response_uncacheable'):
+                        return response
+
+                    data = response.get_data()
+                    entry = {
+                        'data': data,
+                        'etag': hashlib.sha1(data).hexdigest(),
+                        'mimetype': response.mimetype,
+                        'last_modified': int(time.time())
+                    }
+                    self.backend.set(key, entry, self.timeout)
+
+                return self.build_response(entry)
+
+            return decorated_function
+
+        return decorator
+
+    @staticmethod
+    def uncacheable():
+        """
+        Marks response of the current request as not to be cached, e.g. when
+        it shows a temporary state.
+        """
+        g.response_uncacheable = True
+
+    @staticmethod
+    def build_response(entry):
+        """
+        Creates response from the cache entry. Answers with '304 Not Modified'
+        if the client already has the same version.
+        """
+        response = Response(entry['data'], mimetype=entry['mimetype'])
+        response.set_etag(entry['etag'])
+        response.last_modified = entry['last_modified']
+        # user specific - browsers may keep it, but have to revalidate
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+        return response.make_conditional(request)
+
+
+##
+# TEMPLATE CACHES
+##
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Jinja {% cache %} tag - keeps the rendered fragment in the environment's
+    fragment_cache backend under a key built from the tag's arguments, e.g.
+
+        {% cache 'item-card', item.id, item.version %} ... {% endcache %}
+
+    Arguments have to identify everything the fragment shows (versions of
+    the records). Fragments are shared by all users - parts depending on the
+    logged user have to stay outside of them.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        # set by the app - no backend renders fragments every time
+        environment.extend(fragment_cache=None, fragment_cache_timeout=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(
+                self.call_method('_render', [nodes.List(args)]), [], [],
+                body).set_lineno(lineno)
+
+    def _render(self, key_parts, caller):
+        backend = self.environment.fragment_cache
+        if backend is None:
+            return caller()
+
+        key = 'fragment:' + ':'.join(str(part) for part in key_parts)
+        fragment = backend.get(key)
+
+        if fragment is None:
+            # fragments showing a temporary state (see
+            # ResponseCache.uncacheable()) are not cached either
+            uncacheable = g.pop('response_uncacheable', False)
+            fragment = str(caller())
+
+            if not g.get('response_uncacheable'):
+                backend.set(key, fragment,
+                            self.environment.fragment_cache_timeout)
+            if uncacheable:
+                g.response_uncacheable = True
+
+        return Markup(fragment)
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    Compiled templates kept in a folder shared by all worker processes, so a
+    started worker loads them instead of compiling. Files are written to a
+    temporary file and renamed - a worker never reads a partially written
+    one.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        super(TemplateBytecodeCache, self).__init__(directory)
+
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the template stays compiled in memory
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def precompile_templates(environment):
+    """
+    Compiles all templates at startup into the environment's in-memory cache
+    (and the bytecode cache), so no request compiles a template. Worker
+    processes forked afterwards get the compiled templates with the app.
+
+    :param environment: Jinja environment of the app
+    :return: Number of compiled templates
+    """
+    names = environment.list_templates(
+            filter_func=lambda name: name.endswith('.html'))
+
+    for name in names:
+        environment.get_template(name)
+
+    return len(names)
@@ -0,0 +1,328 @@
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import and_, bindparam, event, inspect, literal, or_, select
+from sqlalchemy.orm import raiseload
+
+from model import Category, ChangeCounter, Item, Tombstone
+from serializers import CATEGORY_SCHEMA, ITEM_SCHEMA
+
+##
+# VERSIONS
+##
+
+# Records of the change feed - within a version categories come first, so
+# clients see a new category before it's items, and deletions come last
+FEED_MODELS = (Category, Item, Tombstone)
+
+
+def next_version(session):
+    """
+    Version of the changes made in the session's transaction. Allocated once
+    per transaction by incrementing the counter row, which stays locked until
+    the commit - versions are committed in increasing order, so a client that
+    has seen a version never misses an earlier one.
+
+    :param session: SQLAlchemy session
+    :return: Version number
+    """
+    version = session.info.get('change_version')
+
+    if version is None:
+        counter = ChangeCounter.__table__
+        session.execute(counter.update().values(
+                version=counter.c.version + 1))
+        version = session.execute(select([counter.c.version])).scalar()
+        session.info['change_version'] = version
+
+    return version
+
+
+def stamp(session, rows):
+    """
+    Sets version and update time of rows written with Core statements (bulk
+    INSERT or UPDATE).
+
+    :param session: SQLAlchemy session
+    :param rows: list of dicts with column values
+    :return: The rows
+    """
+    version = next_version(session)
+    updated_at = time.time()
+
+    for row in rows:
+        row['version'] = version
+        row['updated_at'] = updated_at
+
+    return rows
+
+
+def bury_items(session, condition):
+    """
+    Adds tombstones of items matching the condition with a single INSERT ...
+    SELECT. Has to be called before the bulk DELETE of the items.
+
+    :param session: SQLAlchemy session
+    :param condition: SQL expression selecting the items
+    """
+    items = select([literal('item'), Item.id, Item.category_id,
+                    literal(next_version(session)), literal(time.time())]) \
+        .where(condition)
+
+    session.execute(Tombstone.__table__.insert().from_select(
+            ['kind', 'record_id', 'category_id', 'version', 'deleted_at'],
+            items))
+
+
+def track_changes(session_factory, notifier=None):
+    """
+    Stamps categories and items modified through the ORM with the version of
+    their transaction, leaves tombstones of the deleted ones and updates
+    aggregates of categories with added, modified, moved or deleted items.
+
+    :param session_factory: sessionmaker (or Session class) to track
+    :param notifier: ChangeNotifier told about every committed version
+    """
+
+    @event.listens_for(session_factory, 'before_flush')
+    def stamp_changes(db_session, flush_context, instances):
+        now = time.time()
+        deltas = Counter()
+
+        for record in list(db_session.new) + list(db_session.dirty):
+            if isinstance(record, (Category, Item)) and (
+                    record in db_session.new or
+                    db_session.is_modified(record)):
+                record.version = next_version(db_session)
+                record.updated_at = now
+
+                if isinstance(record, Item):
+                    count_moved_item(db_session, record, deltas)
+
+        for record in list(db_session.deleted):
+            if isinstance(record, Category):
+                kind, category_id = 'category', record.id
+            elif isinstance(record, Item):
+                kind, category_id = 'item', committed_category_id(record)
+                deltas[category_id] -= 1
+            else:
+                continue
+
+            db_session.add(Tombstone(kind=kind, record_id=record.id,
+                                     category_id=category_id,
+                                     version=next_version(db_session),
+                                     deleted_at=now))
+
+        count_items(db_session, deltas)
+
+    @event.listens_for(session_factory, 'after_commit')
+    def notify_changes(db_session):
+        version = db_session.info.get('change_version')
+        if version is not None and notifier is not None:
+            notifier.notify(version)
+
+    @event.listens_for(session_factory, 'after_transaction_end')
+    def forget_version(db_session, transaction):
+        # the next transaction (after commit or rollback) gets a new version
+        if transaction.parent is None:
+            db_session.info.pop('change_version', None)
+
+
+##
+# CATEGORY AGGREGATES
+##
+
+
+def committed_category_id(item):
+    """
+    :return: Id of the item's category in the database (before changes made
+             in the session)
+    """
+    history = inspect(item).attrs.category_id.history
+    if history.deleted:
+        return int(history.deleted[0])
+    return int(item.category_id)
+
+
+def count_moved_item(session, item, deltas):
+    """
+    Adds changes of categories' item counts caused by the new or modified
+    item to deltas. Views set category_id from the form (a string), so ids
+    are compared as numbers.
+    """
+    if item in session.new:
+        deltas[int(item.category_id)] += 1
+        return
+
+    old_category_id = committed_category_id(item)
+    new_category_id = int(item.category_id)
+
+    # modified items change items_updated_at of the category
+    deltas[old_category_id] += 0
+    if old_category_id != new_category_id:
+        deltas[old_category_id] -= 1
+        deltas[new_category_id] += 1
+
+
+def count_items(session, deltas):
+    """
+    Updates item_count and items_updated_at of categories whose items were
+    added, modified, moved or deleted with a single executemany UPDATE, in
+    the transaction changing the items. The categories get the version of
+    the transaction, so their listings and the change feed show new counts.
+
+    :param session: SQLAlchemy session
+    :param deltas: dict category id -> change of the number of items (0 if
+                   the items were only modified)
+    """
+    if not deltas:
+        return
+
+    now = time.time()
+    category = Category.__table__
+
+    session.execute(
+            category.update()
+            .where(category.c.id == bindparam('category_id'))
+            .values(item_count=category.c.item_count + bindparam('delta'),
+                    items_updated_at=now, version=next_version(session),
+                    updated_at=now),
+            [{'category_id': category_id, 'delta': delta}
+             for category_id, delta in sorted(deltas.items())])
+
+
+##
+# CHANGE FEED
+##
+
+
+def parse_cursor(cursor):
+    """
+    Reads the cursor returned with the previous page of changes. A plain
+    version number means "changes made after that version".
+
+    :param cursor: Cursor string, None starts from the beginning
+    :return: tuple (version, model index, id) or None if cursor is invalid
+    """
+    if not cursor:
+        return 0, -1, 0
+
+    try:
+        parts = [int(part) for part in cursor.split('.')]
+    except ValueError:
+        return None
+
+    if len(parts) == 1:
+        return parts[0], len(FEED_MODELS), 0
+    if len(parts) != 3 or min(parts) < 0:
+        return None
+
+    return tuple(parts)
+
+
+def format_cursor(cursor):
+    return '{}.{}.{}'.format(*cursor)
+
+
+def read_changes(session, cursor, limit):
+    """
+    Reads categories, items and tombstones changed after the cursor, ordered
+    by (version, model, id). Every model is read with one query walking it's
+    (version, id) index.
+
+    :param session: SQLAlchemy session
+    :param cursor: tuple (version, model index, id) from parse_cursor()
+    :param limit: Maximal number of changes
+    :return: tuple (list of (cursor, record), cursor of the last change,
+             has_more)
+    """
+    version, index, last_id = cursor
+
+    changes = []
+    for model_index, model in enumerate(FEED_MODELS):
+        if model_index < index:
+            condition = model.version > version
+        elif model_index == index:
+            condition = or_(model.version > version,
+                            and_(model.version == version,
+                                 model.id > last_id))
+        else:
+            condition = model.version >= version
+
+        records = session.query(model).options(raiseload('*')) \
+            .filter(condition) \
+            .order_by(model.version, model.id) \
+            .limit(limit + 1)
+
+        changes.extend(((record.version, model_index, record.id), record)
+                       for record in records)
+
+    changes.sort(key=lambda change: change[0])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    if changes:
+        cursor = changes[-1][0]
+
+    return changes, cursor, has_more
+
+
+def serialize_change(record):
+    """
+    :param record: Category, Item or Tombstone
+    :return: dict describing the change
+    """
+    if isinstance(record, Tombstone):
+        return {
+            'type': record.kind,
+            'id': record.record_id,
+            'category_id': record.category_id,
+            'version': record.version,
+            'updated_at': record.deleted_at,
+            'deleted': True
+        }
+
+    if isinstance(record, Category):
+        kind, schema = 'category', CATEGORY_SCHEMA
+    else:
+        kind, schema = 'item', ITEM_SCHEMA
+
+    return {
+        'type': kind,
+        'id': record.id,
+        'version': record.version,
+        'updated_at': record.updated_at,
+        'deleted': False,
+        kind: schema.dump(record)
+    }
+
+
+class ChangeNotifier(object):
+    """
+    Wakes requests waiting for changes (long-poll, event stream) when this
+    process commits a change. Changes committed by other processes are found
+    by polling the database.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.version = 0
+
+    def notify(self, version):
+        with self._condition:
+            self.version = max(self.version, version)
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        """
+        Blocks until a version newer than given one is committed or the
+        timeout passes.
+
+        :param version: The last version known to the caller
+        :param timeout: Seconds
+        :return: True if a newer version was committed
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                    lambda: self.version > version, timeout)
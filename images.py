@@ -0,0 +1,216 @@
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+##
+# PICTURE VARIANTS
+##
+
+# Resized copies generated for every uploaded picture - name: bounding box.
+# The original upload is kept untouched.
+VARIANTS = {
+    'thumb': (240, 240),
+    'medium': (640, 640),
+}
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+
+def variant_filename(filename, variant, webp=False):
+    """
+    Returns name of the resized picture variant.
+
+    e.g. variant_filename('abc.png', 'thumb') -> 'abc.thumb.jpg'
+
+    :param filename: Name of the original picture
+    :param variant: 'thumb', 'medium' or 'original'
+    :param webp: True for the WebP version of the variant
+    :return: Name of the variant's file or None if there is no picture
+    """
+    if not filename:
+        return None
+
+    if variant == 'original':
+        return filename
+
+    stem = os.path.splitext(filename)[0]
+    return '{}.{}.{}'.format(stem, variant, 'webp' if webp else 'jpg')
+
+
+def all_variant_filenames(filename):
+    """
+    :return: list of names of all variants that may exist for the picture
+    """
+    return [variant_filename(filename, variant, webp)
+            for variant in VARIANTS for webp in (False, True)]
+
+
+def picture_variants(filename):
+    """
+    Names of all variants of the picture, as exposed by the API.
+
+    :param filename: Name of the original picture
+    :return: dict variant -> file name (empty if there is no picture)
+    """
+    if not filename:
+        return {}
+
+    variants = {'original': filename}
+    for variant in VARIANTS:
+        variants[variant] = variant_filename(filename, variant)
+
+    return variants
+
+
+def is_variant(filename):
+    """
+    :return: True if the file is a generated variant, not an upload
+    """
+    stem = os.path.splitext(filename)[0]
+    return os.path.splitext(stem)[1][1:] in VARIANTS
+
+
+def save_atomically(image, path, **params):
+    """
+    Saves image to a temporary file and renames it, so readers never see a
+    partially written file.
+    """
+    tmp_path = path + '.tmp'
+    image.save(tmp_path, **params)
+    os.replace(tmp_path, path)
+
+
+def generate_variants(folder, filename, webp=False):
+    """
+    Creates resized, re-encoded JPEG (and optionally WebP) variants of the
+    uploaded picture.
+
+    :param folder: Folder with uploaded pictures
+    :param filename: Name of the original picture
+    :param webp: True to generate WebP variants too
+    """
+    try:
+        with Image.open(os.path.join(folder, filename)) as original:
+            original.load()
+            image = original.convert('RGBA') \
+                if original.mode in ('P', 'LA') else original
+
+            if image.mode == 'RGBA':
+                # JPEG has no transparency - put the picture on white
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.split()[3])
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+
+            for variant, size in VARIANTS.items():
+                resized = image.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+
+                save_atomically(resized, os.path.join(
+                        folder, variant_filename(filename, variant)),
+                        format='JPEG', quality=JPEG_QUALITY, optimize=True,
+                        progressive=True)
+
+                if webp:
+                    save_atomically(resized, os.path.join(
+                            folder, variant_filename(filename, variant, True)),
+                            format='WEBP', quality=WEBP_QUALITY)
+
+    except Exception:
+        # runs in the worker's thread - nobody reads the future's exception
+        log.exception("There was an error resizing file: '{}'.".format(
+                filename))
+
+
+class VariantWorker(object):
+    """
+    Generates picture variants in a background thread pool, so the request
+    handling the upload doesn't wait for the resizing. Pillow releases the
+    GIL while decoding and resizing, so the threads run in parallel.
+    """
+
+    def __init__(self, folder, max_workers=2, webp=False):
+        self.folder = folder
+        self.webp = webp
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # pictures with all variants on disk, and pictures ever queued by
+        # this process - a picture is queued once, even if resizing fails
+        self.available = set()
+        self.queued = set()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def schedule(self, filename):
+        """
+        Queues generation of variants of the uploaded picture.
+
+        :param filename: Name of the file in the uploads folder
+        :return: Future of the generation
+        """
+        with self.lock:
+            self.queued.add(filename)
+            self.pending.add(filename)
+
+        future = self.executor.submit(generate_variants, self.folder,
+                                      filename, self.webp)
+        future.add_done_callback(lambda f: self.pending.discard(filename))
+        return future
+
+    def shutdown(self):
+        """
+        Stops the threads once the queued variants are generated.
+        """
+        self.executor.shutdown(wait=False)
+
+    def ready(self, filename):
+        """
+        Tells whether the variants of the picture exist. Missing variants
+        (e.g. of pictures uploaded before variants were generated) are
+        queued, once per picture. Found variants are remembered, so the disk
+        is checked only until they appear.
+
+        :param filename: Name of the original picture
+        :return: True if all variants exist
+        """
+        if filename in self.available:
+            return True
+
+        if all(os.path.exists(os.path.join(
+                self.folder, variant_filename(filename, variant)))
+               for variant in VARIANTS):
+            self.available.add(filename)
+            return True
+
+        with self.lock:
+            if filename in self.queued:
+                return False
+            self.queued.add(filename)
+
+        self.schedule(filename)
+        return False
+
+
+if __name__ == "__main__":
+    # Generates missing variants for pictures uploaded before - usage:
+    # python3 images.py [uploads folder] [--webp]
+    folder = 'static/uploads/'
+    if len(sys.argv) > 1 and not sys.argv[1].startswith('--'):
+        folder = sys.argv[1]
+    webp = '--webp' in sys.argv
+
+    for name in sorted(os.listdir(folder)):
+        if is_variant(name) or name.endswith('.tmp'):
+            continue
+
+        if not all(os.path.exists(os.path.join(folder, variant))
+                   for variant in all_variant_filenames(name)
+                   if webp or not variant.endswith('.webp')):
+            print("Generating variants of '{}'.".format(name))
+            generate_variants(folder, name, webp)
@@ -0,0 +1,231 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from jinja2 import Template
+
+##
+# REQUEST TIMINGS
+##
+
+# Parts of the request measured separately from the total time
+PHASES = ('db', 'template', 'upload', 'http')
+
+# Upper bounds (seconds) of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def record(phase, seconds):
+    """
+    Adds time spent in the phase to the current request. Does nothing
+    outside of a request (e.g. in background threads).
+
+    :param phase: One of PHASES
+    :param seconds: Measured time
+    """
+    if has_request_context():
+        timings = g.setdefault('metrics_timings', {})
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    """
+    Measures the block and records it as the phase of the current request.
+
+    e.g. with timed('http'): response = requests.get(url)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+class TimedTemplate(Template):
+    """
+    Jinja template recording it's render time. Set as template_class of the
+    app's Jinja environment, so every render_template is measured.
+    """
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+class Metrics(object):
+    """
+    Per-endpoint statistics of handled requests - counts by status, duration
+    histogram, time spent in every phase and number of SQL queries. Rendered
+    in Prometheus text format. Safe to use from many threads, every worker
+    process keeps it's own numbers.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (endpoint, status) -> number of requests
+        self._requests = {}
+        # endpoint -> [count in every bucket..., count, sum of durations]
+        self._durations = {}
+        # (endpoint, phase) -> seconds
+        self._phases = {}
+        # endpoint -> number of SQL queries
+        self._queries = {}
+        self._slow_queries = 0
+
+    def observe(self, endpoint, status, duration, timings, queries):
+        """
+        Records a finished request.
+
+        :param endpoint: Name of the view
+        :param status: HTTP status code of the response
+        :param duration: Total time of the request in seconds
+        :param timings: dict phase -> seconds
+        :param queries: Number of executed SQL queries
+        """
+        with self._lock:
+            key = (endpoint, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            histogram = self._durations.setdefault(
+                    endpoint, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+
+            for phase in PHASES:
+                key = (endpoint, phase)
+                self._phases[key] = self._phases.get(key, 0) + \
+                    timings.get(phase, 0)
+
+            self._queries[endpoint] = self._queries.get(endpoint, 0) + queries
+
+    def slow_query(self):
+        with self._lock:
+            self._slow_queries += 1
+
+    def render(self):
+        """
+        :return: All metrics in Prometheus text exposition format
+        """
+        with self._lock:
+            requests = sorted(self._requests.items())
+            durations = sorted((endpoint, list(histogram)) for
+                               endpoint, histogram in self._durations.items())
+            phases = sorted(self._phases.items())
+            queries = sorted(self._queries.items())
+            slow_queries = self._slow_queries
+
+        lines = ['# HELP app_requests_total Handled requests.',
+                 '# TYPE app_requests_total counter']
+        for (endpoint, status), count in requests:
+            lines.append('app_requests_total{{endpoint="{}",status="{}"}} {}'
+                         .format(endpoint, status, count))
+
+        lines += ['# HELP app_request_duration_seconds Time of requests.',
+                  '# TYPE app_request_duration_seconds histogram']
+        for endpoint, histogram in durations:
+            total = histogram[-2]
+            for bound, count in zip(self.buckets, histogram):
+                lines.append('app_request_duration_seconds_bucket{{'
+                             'endpoint="{}",le="{}"}} {}'
+                             .format(endpoint, bound, count))
+            lines.append('app_request_duration_seconds_bucket{{'
+                         'endpoint="{}",le="+Inf"}} {}'
+                         .format(endpoint, total))
+            lines.append('app_request_duration_seconds_sum{{endpoint="{}"}} '
+                         '{:.6f}'.format(endpoint, histogram[-1]))
+            lines.append('app_request_duration_seconds_count{{endpoint="{}"}}'
+                         ' {}'.format(endpoint, total))
+
+        lines += ['# HELP app_request_phase_seconds_total Time of requests '
+                  'spent in the DB, templates, upload I/O and outbound HTTP.',
+                  '# TYPE app_request_phase_seconds_total counter']
+        for (endpoint, phase), seconds in phases:
+            lines.append('app_request_phase_seconds_total{{endpoint="{}",'
+                         'phase="{}"}} {:.6f}'.format(endpoint, phase,
+                                                      seconds))
+
+        lines += ['# HELP app_sql_queries_total Executed SQL queries.',
+                  '# TYPE app_sql_queries_total counter']
+        for endpoint, count in queries:
+            lines.append('app_sql_queries_total{{endpoint="{}"}} {}'
+                         .format(endpoint, count))
+
+        lines += ['# HELP app_slow_sql_queries_total SQL queries slower '
+                  'than the threshold.',
+                  '# TYPE app_slow_sql_queries_total counter',
+                  'app_slow_sql_queries_total {}'.format(slow_queries)]
+
+        return '\n'.join(lines) + '\n'
+
+
+##
+# SAMPLED PROFILING
+##
+
+
+class SampledProfiler(object):
+    """
+    Runs cProfile for a random sample of requests and keeps the profile of
+    those slower than the threshold. Only one request is profiled at a time -
+    the profiler would slow down (and mix up) concurrent requests.
+    """
+
+    def __init__(self, folder, sample_rate=0.0, threshold=1.0):
+        """
+        :param folder: Folder the .prof files are written to
+        :param sample_rate: Part of requests profiled (0.01 = 1%), 0 is off
+        :param threshold: Seconds - faster requests are not saved
+        """
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        :return: Running cProfile.Profile or None if request is not sampled
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+
+        if not self._lock.acquire(False):
+            # another request is being profiled
+            return None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, duration, name):
+        """
+        Stops the profiler started with start().
+
+        :param profile: Profile returned by start()
+        :param duration: Total time of the request in seconds
+        :param name: Name of the profiled view, used in the file name
+        :return: Path of the saved profile or None if request was fast
+        """
+        try:
+            profile.disable()
+        finally:
+            self._lock.release()
+
+        if duration < self.threshold:
+            return None
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+        path = os.path.join(self.folder, '{}-{}-{:.0f}ms.prof'.format(
+                name, time.strftime('%Y%m%d-%H%M%S'), duration * 1000))
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,365 @@
+"""
+Schema migrations and query plan checks.
+
+Upgrade the database (DATABASE_URL, itemsapp.db by default) to the current
+schema - an empty database is created from scratch:
+
+    python3 migrations.py upgrade
+
+Check that the queries the views run are served by indexes:
+
+    python3 migrations.py check
+"""
+import sys
+import time
+
+from sqlalchemy import Column, Integer, MetaData, Table, bindparam, func, \
+    inspect, select, text, tuple_
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+
+from database import DATABASE_URL, create_db_engine
+from model import Base, Category, ChangeCounter, Item, SEARCH_INDEX_DDL, \
+    SEARCH_UPDATE_TRIGGERS, Tombstone, User, parse_price
+
+##
+# MIGRATIONS
+##
+
+# Version of the schema the database is at - a single row
+schema_version = Table('schema_version', MetaData(),
+                       Column('version', Integer, nullable=False))
+
+
+def add_search_index(connection):
+    """
+    Full-text search index of items and categories (SQLite only).
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+
+    exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_index'")) \
+        .scalar()
+
+    if not exists:
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(text(statement))
+
+
+def add_access_path_indexes(connection):
+    """
+    Indexes of the columns the views filter by - items of a category, records
+    of a user and uploaded pictures.
+    """
+    create_missing_indexes(connection, Category, Item)
+
+
+def add_change_tracking(connection):
+    """
+    Versions of categories and items and the counter of changes, used by the
+    change feed. Existing records get version 0.
+    """
+    for model in (Category, Item):
+        if add_missing_columns(connection, model, 'version', 'updated_at'):
+            connection.execute(model.__table__.update().values(
+                    updated_at=time.time()))
+
+    create_missing_indexes(connection, Category, Item, Tombstone)
+
+    counter = ChangeCounter.__table__
+    if connection.execute(counter.select()).first() is None:
+        connection.execute(counter.insert().values(id=1, version=0))
+
+
+def add_category_aggregates(connection):
+    """
+    Numbers of items of categories and times of the latest change of their
+    items, computed from existing items.
+    """
+    if add_missing_columns(connection, Category, 'item_count',
+                           'items_updated_at'):
+        count_category_items(connection)
+
+
+def convert_prices(connection):
+    """
+    Prices as integer minor units instead of text, indexed with the category
+    of the item. Text prices are parsed as amounts in major units, items with
+    an unreadable price are left without it. The old column is dropped where
+    the database can do it (SQLite 3.35+).
+    """
+    columns = {column['name'] for column in
+               inspect(connection).get_columns('item')}
+
+    if add_missing_columns(connection, Item, 'price_cents') and \
+            'price' in columns:
+        item = Item.__table__
+        prices = [{'item_id': item_id, 'price_cents': parse_price(price)}
+                  for item_id, price in connection.execute(text(
+                      'SELECT id, price FROM item WHERE price IS NOT NULL'))]
+
+        if prices:
+            connection.execute(item.update()
+                               .where(item.c.id == bindparam('item_id'))
+                               .values(price_cents=bindparam('price_cents')),
+                               prices)
+
+    create_missing_indexes(connection, Item)
+
+    if 'price' in columns and (
+            connection.dialect.name != 'sqlite' or
+            connection.dialect.server_version_info >= (3, 35)):
+        connection.execute(text('ALTER TABLE item DROP COLUMN price'))
+
+
+def narrow_search_triggers(connection):
+    """
+    Search index update triggers firing only on changes of the indexed
+    columns - version and item count bumps rewrote the index rows (SQLite
+    only).
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+
+    for name, statement in SEARCH_UPDATE_TRIGGERS.items():
+        sql = connection.execute(text(
+                "SELECT sql FROM sqlite_master "
+                "WHERE type = 'trigger' AND name = :name"), name=name) \
+            .scalar()
+
+        if sql is not None and 'UPDATE OF' not in sql:
+            connection.execute(text('DROP TRIGGER {}'.format(name)))
+            connection.execute(text(statement))
+
+
+# Applied in this order, the version of the schema is the number of applied
+# migrations. Never reorder or remove a migration - add a new one instead.
+# Databases created from scratch get the tables in the current form, so
+# every migration has to skip changes that are already there.
+MIGRATIONS = [
+    add_search_index,
+    add_access_path_indexes,
+    add_change_tracking,
+    add_category_aggregates,
+    convert_prices,
+    narrow_search_triggers,
+]
+
+
+def create_missing_indexes(connection, *models):
+    """
+    Creates indexes declared on the models that the database doesn't have.
+    Indexes of columns the table doesn't have yet are left to the migration
+    adding the columns.
+    """
+    inspector = inspect(connection)
+
+    for model in models:
+        existing = {index['name'] for index in
+                    inspector.get_indexes(model.__tablename__)}
+        columns = {column['name'] for column in
+                   inspector.get_columns(model.__tablename__)}
+
+        for index in model.__table__.indexes:
+            if index.name not in existing and \
+                    {column.name for column in index.columns} <= columns:
+                index.create(connection)
+
+
+def add_missing_columns(connection, model, *names):
+    """
+    Adds columns declared on the model that the table doesn't have. New
+    columns need a server default (or have to be nullable).
+
+    :return: list of names of added columns
+    """
+    table = model.__table__
+    existing = {column['name'] for column in
+                inspect(connection).get_columns(table.name)}
+
+    added = []
+    for name in names:
+        if name not in existing:
+            connection.execute(text('ALTER TABLE {} ADD COLUMN {}'.format(
+                    connection.dialect.identifier_preparer.format_table(
+                            table),
+                    CreateColumn(table.c[name]).compile(
+                            dialect=connection.dialect))))
+            added.append(name)
+
+    return added
+
+
+def count_category_items(connection):
+    """
+    Recomputes aggregates of all categories from their items. Needed after
+    items are inserted without the app (e.g. by benchmark.py seed).
+    """
+    category = Category.__table__
+    item = Item.__table__
+    in_category = item.c.category_id == category.c.id
+
+    connection.execute(category.update().values(
+            item_count=select([func.count(item.c.id)]).where(in_category)
+            .as_scalar(),
+            items_updated_at=func.coalesce(
+                    select([func.max(item.c.updated_at)]).where(in_category)
+                    .as_scalar(), 0)))
+
+
+def get_version(connection):
+    """
+    :return: Version of the database's schema
+    """
+    version = connection.execute(schema_version.select()).scalar()
+    if version is None:
+        connection.execute(schema_version.insert().values(version=0))
+        return 0
+
+    return version
+
+
+def migrate(engine):
+    """
+    Creates missing tables and applies pending migrations. Every migration
+    runs in it's own transaction together with the version update, so an
+    interrupted upgrade continues with the failed migration next time.
+
+    :param engine: SQLAlchemy engine of the database
+    :return: list of names of applied migrations
+    """
+    Base.metadata.create_all(engine)
+    schema_version.create(engine, checkfirst=True)
+
+    applied = []
+    while True:
+        with engine.begin() as connection:
+            version = get_version(connection)
+            if version >= len(MIGRATIONS):
+                return applied
+
+            migration = MIGRATIONS[version]
+            migration(connection)
+            connection.execute(schema_version.update().values(
+                    version=version + 1))
+
+        applied.append(migration.__name__)
+
+
+##
+# QUERY PLANS
+##
+
+
+def hot_queries(session):
+    """
+    Queries run by the views on every request, with tables they are allowed
+    to read whole (e.g. the listing of all categories).
+
+    :return: list of (name, query, tables allowed to be scanned)
+    """
+    return [
+        ('category_view', session.query(Category), {'category'}),
+        ('categories page', session.query(Category)
+         .filter(Category.id > 0).order_by(Category.id).limit(101), set()),
+        ('category by id', session.query(Category).filter_by(id=1), set()),
+        ('items of category', session.query(Item).filter_by(category_id=1),
+         set()),
+        ('items page', session.query(Item).filter_by(category_id=1)
+         .filter(Item.id > 0).order_by(Item.id).limit(101), set()),
+        ('items by price', session.query(Item).filter_by(category_id=1)
+         .filter(Item.price_cents.between(100, 5000))
+         .filter(tuple_(Item.price_cents, Item.id) > tuple_(100, 0))
+         .order_by(Item.price_cents, Item.id).limit(101), set()),
+        ('item by id', session.query(Item).filter_by(id=1, category_id=1),
+         set()),
+        ('user by id', session.query(User).filter_by(id=1), set()),
+        ('user by email', session.query(User)
+         .filter_by(email='user@example.com'), set()),
+        ('categories of user', session.query(Category).filter_by(user_id=1),
+         set()),
+        ('items of user', session.query(Item).filter_by(user_id=1), set()),
+        ('referenced item pictures', session.query(Item.picture)
+         .filter(Item.picture.in_(['a.png', 'b.png'])).distinct(), set()),
+        ('referenced category pictures', session.query(Category.picture)
+         .filter(Category.picture.in_(['a.png', 'b.png'])).distinct(),
+         set()),
+        ('existing categories', session.query(Category.id)
+         .filter(Category.id.in_([1, 2])), set()),
+        ('changed categories', session.query(Category)
+         .filter(Category.version > 0)
+         .order_by(Category.version, Category.id).limit(101), set()),
+        ('changed items', session.query(Item).filter(Item.version > 0)
+         .order_by(Item.version, Item.id).limit(101), set()),
+        ('tombstones', session.query(Tombstone)
+         .filter(Tombstone.version > 0)
+         .order_by(Tombstone.version, Tombstone.id).limit(101), set()),
+    ]
+
+
+def full_scans(connection, query):
+    """
+    Runs EXPLAIN QUERY PLAN of the query (SQLite only).
+
+    :return: list of names of tables read whole by the query
+    """
+    statement = query.statement.compile(
+            dialect=connection.dialect,
+            compile_kwargs={'literal_binds': True})
+    plan = connection.execute(text('EXPLAIN QUERY PLAN {}'.format(
+            statement))).fetchall()
+
+    scanned = []
+    for row in plan:
+        # e.g. 'SCAN item', 'SCAN item USING INDEX ...' (reads the whole
+        # index) or 'SCAN TABLE item' in older SQLite
+        words = row[-1].split()
+        if words[0] == 'SCAN' and words[1] != 'CONSTANT':
+            scanned.append(words[2] if words[1] == 'TABLE' else words[1])
+
+    return scanned
+
+
+def check_query_plans(engine):
+    """
+    Checks that none of the hot queries reads a whole table it shouldn't.
+
+    :return: list of problems, empty if all plans are fine
+    """
+    if engine.dialect.name != 'sqlite':
+        return []
+
+    problems = []
+    with engine.connect() as connection:
+        session = Session(bind=connection)
+        for name, query, allowed in hot_queries(session):
+            for table in full_scans(connection, query):
+                if table not in allowed:
+                    problems.append("'{}' scans the whole '{}' table."
+                                    .format(name, table))
+        session.close()
+
+    return problems
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    engine = create_db_engine(DATABASE_URL)
+
+    if command == 'upgrade':
+        for name in migrate(engine):
+            print("Applied migration '{}'.".format(name))
+
+    elif command == 'check':
+        migrate(engine)
+        problems = check_query_plans(engine)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("All query plans use indexes.")
+
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -1,10 +1,16 @@
+import os
 import random
 import string
+import tempfile
+import time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
 
+from flask import current_app, has_app_context
 from itsdangerous import BadSignature, SignatureExpired, \
     TimedJSONWebSignatureSerializer as Serializer
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String
+from sqlalchemy import and_, literal, or_, select, text, union_all
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -12,8 +18,76 @@ from sqlalchemy.orm import relationship
 # MODEL DECLARATION (SQL ALCHEMY SETUP)
 ##
 
-SECRET_KEY = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                     for x in range(32))
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', 'secret_key')
+TOKEN_EXPIRATION = 600
+
+
+@lru_cache(maxsize=None)
+def load_secret_key():
+    """
+    Returns the default key signing API tokens, used when the app is not
+    configured with a SECRET_KEY. Taken from SECRET_KEY environment variable
+    or from SECRET_KEY_FILE, which is created with a random key on the first
+    run. All worker processes share the key and tokens stay valid after
+    restart. Read once, on the first call.
+
+    :return: Secret key
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+
+    if not os.path.exists(SECRET_KEY_FILE):
+        key = ''.join(random.SystemRandom().choice(
+                string.ascii_letters + string.digits) for x in range(64))
+
+        # the key is written to a temporary file and linked in place - the
+        # key file appears with the whole key, so a concurrently starting
+        # worker never reads it half written. Linking fails if another
+        # worker was first.
+        fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(SECRET_KEY_FILE)),
+                suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as key_file:
+                key_file.write(key)
+                key_file.flush()
+                os.fsync(key_file.fileno())
+            os.link(tmp_path, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    with open(SECRET_KEY_FILE) as key_file:
+        key = key_file.read().strip()
+
+    if not key:
+        raise RuntimeError("Secret key file '{}' is empty - delete it to "
+                           "generate a new key.".format(SECRET_KEY_FILE))
+
+    return key
+
+
+def get_token_serializer(expiration=TOKEN_EXPIRATION):
+    """
+    Serializer of API tokens signed with the SECRET_KEY of the current app
+    (with load_secret_key() outside of an app context).
+    """
+    key = None
+    if has_app_context():
+        key = current_app.config.get('SECRET_KEY')
+
+    return make_token_serializer(key or load_secret_key(), expiration)
+
+
+@lru_cache(maxsize=16)
+def make_token_serializer(key, expiration):
+    """
+    Created once per key and expiration - building a serializer derives the
+    signing key every time.
+    """
+    return Serializer(key, expires_in=expiration)
+
 
 Base = declarative_base()
 
@@ -25,24 +99,27 @@ class User(Base):
     email = Column(String(128), unique=True)
     picture = Column(String(1024))
 
-    def generate_auth_token(self, expiration=600):
-        s = Serializer(SECRET_KEY, expires_in=expiration)
-        return s.dumps({'id': self.id})
+    def generate_auth_token(self, expiration=TOKEN_EXPIRATION):
+        return get_token_serializer(expiration).dumps({'id': self.id})
 
     @staticmethod
-    def verify_auth_token(token):
-        s = Serializer(SECRET_KEY)
+    def read_auth_token(token):
+        """
+        Verifies the token.
 
+        :return: tuple (user id, expiration timestamp) or None if the token
+                 is invalid or expired
+        """
         try:
-            data = s.loads(token)
+            data, header = get_token_serializer().loads(token,
+                                                        return_header=True)
         except SignatureExpired:
             # Expired token
             return None
         except BadSignature:
             # Invalid Token
             return None
-        user_id = data['id']
-        return user_id
+        return data['id'], header.get('exp', time.time())
 
 
 class Category(Base):
@@ -50,48 +127,262 @@ class Category(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
     description = Column(String(250))
-    picture = Column(String(250))
+    # looked up when deciding if an uploaded file can be deleted
+    picture = Column(String(250), index=True)
+    # change of the last modification and it's time - see changes.py
+    version = Column(Integer, nullable=False, server_default='0')
+    updated_at = Column(Float, nullable=False, server_default='0')
+    # number of the category's items and time of the latest change of any of
+    # them, kept up to date by changes.count_items()
+    item_count = Column(Integer, nullable=False, server_default='0')
+    items_updated_at = Column(Float, nullable=False, server_default='0')
 
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
 
-    @property
-    def serialize(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'picture': self.picture
-        }
+    __table_args__ = (
+        # categories changed since a version, in the order of the change feed
+        Index('ix_category_version_id', 'version', 'id'),
+    )
 
 
 class Item(Base):
     __tablename__ = 'item'
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
-    price = Column(String(8))
-    picture = Column(String(250))
+    # in minor units (cents) - see parse_price() and format_price()
+    price_cents = Column(Integer)
+    picture = Column(String(250), index=True)
     description = Column(String(250))
+    version = Column(Integer, nullable=False, server_default='0')
+    updated_at = Column(Float, nullable=False, server_default='0')
 
     category_id = Column(Integer, ForeignKey('category.id'))
     category = relationship(Category)
 
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
 
-    @property
-    def serialize(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'price': self.description,
-            'picture': self.picture,
-            'description': self.picture,
-            'user_id': self.user_id,
-            'category_id': self.category_id
-        }
+    __table_args__ = (
+        # items of a category, in the order of the keyset pagination
+        Index('ix_item_category_id_id', 'category_id', 'id'),
+        Index('ix_item_version_id', 'version', 'id'),
+        # items of a category filtered and ordered by price (and id - the
+        # keyset pagination)
+        Index('ix_item_category_id_price', 'category_id', 'price_cents',
+              'id'),
+    )
+
+
+# Largest price in minor units - fits a 32-bit INTEGER column
+MAX_PRICE_CENTS = 2 ** 31 - 1
+
+
+def parse_price(value):
+    """
+    Converts price in major units (e.g. '12.5', 12.5 or 12) to minor units,
+    rounded to whole cents.
+
+    :param value: Price from a form, JSON or an old text column
+    :return: Price in cents or None if it isn't a valid price
+    """
+    if isinstance(value, bool):
+        return None
+
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        return None
+
+    # huge amounts (e.g. '1e400') can't even be rounded to cents
+    if not amount.is_finite() or amount < 0 or \
+            amount > Decimal(MAX_PRICE_CENTS) / 100:
+        return None
+
+    cents = int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    return cents if cents <= MAX_PRICE_CENTS else None
+
+
+def format_price(cents):
+    """
+    :param cents: Price in minor units or None
+    :return: Price in major units as a string (e.g. '12.50') or None
+    """
+    if cents is None:
+        return None
+    return '{}.{:02d}'.format(cents // 100, cents % 100)
+
+
+class PendingDeletion(Base):
+    """
+    Uploaded file queued for deletion. Added in the same transaction that
+    removes the last reference, the file is deleted by uploads.PictureReaper
+    in the background - even after a crash or restart.
+    """
+    __tablename__ = 'pending_deletion'
+    id = Column(Integer, primary_key=True)
+    filename = Column(String(250), nullable=False)
+    # time.time() of the deletion - files uploaded again later are kept
+    queued_at = Column(Float, nullable=False)
+
+
+class Tombstone(Base):
+    """
+    Deleted category or item, kept so clients of the change feed learn about
+    the deletion.
+    """
+    __tablename__ = 'tombstone'
+    id = Column(Integer, primary_key=True)
+    # 'category' or 'item'
+    kind = Column(String(16), nullable=False)
+    record_id = Column(Integer, nullable=False)
+    category_id = Column(Integer)
+    version = Column(Integer, nullable=False)
+    deleted_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_tombstone_version_id', 'version', 'id'),
+    )
+
+
+class ChangeCounter(Base):
+    """
+    Single row with the version of the last change of the catalogue.
+    """
+    __tablename__ = 'change_counter'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+##
+# FULL-TEXT SEARCH INDEX
+##
+
+# SQLite FTS5 table indexing names and descriptions of items and categories.
+# Items are stored under rowid id * 2 and categories under id * 2 + 1, so
+# the triggers below update a single row by it's rowid. Created by a
+# migration - see migrations.py.
+
+# Rows of the index are rewritten only when an indexed column changes, not by
+# every bump of the version or of the item count.
+SEARCH_UPDATE_TRIGGERS = {
+    'item_search_update':
+        """CREATE TRIGGER item_search_update
+        AFTER UPDATE OF name, description, category_id ON item BEGIN
+            UPDATE search_index SET name = new.name,
+                                    description = new.description,
+                                    category_id = new.category_id
+            WHERE rowid = old.id * 2;
+        END""",
+    'category_search_update':
+        """CREATE TRIGGER category_search_update
+        AFTER UPDATE OF name, description ON category BEGIN
+            UPDATE search_index SET name = new.name,
+                                    description = new.description
+            WHERE rowid = old.id * 2 + 1;
+        END""",
+}
+
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE search_index USING fts5(
+        name, description, kind UNINDEXED, category_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 1')""",
+
+    """CREATE TRIGGER item_search_insert AFTER INSERT ON item BEGIN
+        INSERT INTO search_index(rowid, name, description, kind, category_id)
+        VALUES (new.id * 2, new.name, new.description, 'item',
+                new.category_id);
+    END""",
+    SEARCH_UPDATE_TRIGGERS['item_search_update'],
+    """CREATE TRIGGER item_search_delete AFTER DELETE ON item BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+    END""",
+
+    """CREATE TRIGGER category_search_insert AFTER INSERT ON category BEGIN
+        INSERT INTO search_index(rowid, name, description, kind, category_id)
+        VALUES (new.id * 2 + 1, new.name, new.description, 'category',
+                new.id);
+    END""",
+    SEARCH_UPDATE_TRIGGERS['category_search_update'],
+    """CREATE TRIGGER category_search_delete AFTER DELETE ON category BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END""",
+
+    # index rows already present in the database
+    """INSERT INTO search_index(rowid, name, description, kind, category_id)
+        SELECT id * 2, name, description, 'item', category_id FROM item""",
+    """INSERT INTO search_index(rowid, name, description, kind, category_id)
+        SELECT id * 2 + 1, name, description, 'category', id
+        FROM category""",
+]
+
+
+def search(session, query, limit, offset=0):
+    """
+    Finds items and categories matching every word of the query (or words
+    starting with it). Results are ranked with bm25 - matches in the name
+    weight more than in the description. Databases other than SQLite have no
+    search index, they are searched with search_like().
+
+    :param session: SQLAlchemy session
+    :param query: Text typed by the user
+    :param limit: Maximal number of results
+    :param offset: Number of results to skip
+    :return: list of rows (kind, id, category_id, name, description)
+    """
+    words = [word.replace('"', '') for word in query.split()]
+    words = [word for word in words if word]
+    if not words:
+        return []
+
+    if session.get_bind().dialect.name != 'sqlite':
+        return search_like(session, words, limit, offset)
+
+    # every word as a quoted prefix query - user input is never parsed as
+    # FTS5 syntax
+    match = ' '.join('"{}"*'.format(word) for word in words)
+
+    return session.execute(text(
+            """SELECT kind, CAST(rowid / 2 AS INTEGER) AS id, category_id,
+                      name, description
+               FROM search_index
+               WHERE search_index MATCH :match
+               ORDER BY bm25(search_index, 10.0, 1.0)
+               LIMIT :limit OFFSET :offset"""),
+            {'match': match, 'limit': limit, 'offset': offset}).fetchall()
+
+
+def search_like(session, words, limit, offset=0):
+    """
+    Finds items and categories with every word in the name or description,
+    without the search index. Results are ordered by name.
+
+    :param session: SQLAlchemy session
+    :param words: Words typed by the user
+    :param limit: Maximal number of results
+    :param offset: Number of results to skip
+    :return: list of rows (kind, id, category_id, name, description)
+    """
+    patterns = ['%{}%'.format(word.replace('\\', '\\\\')
+                              .replace('%', '\\%').replace('_', '\\_'))
+                for word in words]
 
+    selects = []
+    for kind, model, category_id in (('item', Item, Item.category_id),
+                                     ('category', Category, Category.id)):
+        selects.append(select([literal(kind).label('kind'),
+                               model.id.label('id'),
+                               category_id.label('category_id'),
+                               model.name.label('name'),
+                               model.description.label('description')])
+                       .where(and_(*[
+                           or_(model.name.ilike(pattern, escape='\\'),
+                               model.description.ilike(pattern, escape='\\'))
+                           for pattern in patterns])))
 
-engine = create_engine('sqlite:///itemsapp.db')
+    results = union_all(*selects).alias('results')
 
-Base.metadata.create_all(engine)
+    return session.execute(select([results])
+                           .order_by(results.c.name, results.c.kind,
+                                     results.c.id)
+                           .limit(limit).offset(offset)).fetchall()
@@ -0,0 +1,211 @@
+import base64
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from oauth2client import crypt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import timed
+
+##
+# GOOGLE OAUTH CLIENT
+##
+
+GOOGLE_TOKEN_URL = 'https://oauth2.googleapis.com/token'
+GOOGLE_TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+GOOGLE_USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+GOOGLE_REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+
+# Used when the certs response has no max-age
+DEFAULT_CERTS_MAX_AGE = 3600
+
+
+class GoogleClient(object):
+    """
+    Client of Google's OAuth endpoints. All calls go through one pooled HTTP
+    session with timeouts, so connections (and TLS handshakes) are reused
+    between logins. Every URL can be pointed to a local stub server.
+    """
+
+    def __init__(self, client_id, client_secret=None, timeout=5, pool_size=10,
+                 token_url=GOOGLE_TOKEN_URL,
+                 tokeninfo_url=GOOGLE_TOKENINFO_URL,
+                 userinfo_url=GOOGLE_USERINFO_URL,
+                 revoke_url=GOOGLE_REVOKE_URL,
+                 certs_url=GOOGLE_CERTS_URL,
+                 background_workers=0):
+        """
+        :param client_id: OAuth client id of this app
+        :param client_secret: OAuth client secret, for code exchanges
+        :param timeout: Seconds to wait for connection and for response
+        :param pool_size: Connections kept open to every host
+        :param background_workers: Number of threads for background calls
+                                   (see submit()), 0 runs everything
+                                   synchronously
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = timeout
+        self.token_url = token_url
+        self.tokeninfo_url = tokeninfo_url
+        self.userinfo_url = userinfo_url
+        self.revoke_url = revoke_url
+        self.certs_url = certs_url
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=Retry(total=2, backoff_factor=0.1))
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+        self.executor = None
+        if background_workers:
+            self.executor = ThreadPoolExecutor(
+                    max_workers=background_workers)
+
+        self._certs = None
+        self._certs_expire = 0
+        self._certs_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes pooled connections, background calls already submitted are
+        finished.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.http.close()
+
+    def submit(self, function, *args):
+        """
+        Runs the call in the background if there are background workers.
+
+        :return: Future with the result
+        """
+        if self.executor is not None:
+            return self.executor.submit(function, *args)
+
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def get_json(self, url, params):
+        with timed('http'):
+            return self.http.get(url, params=params,
+                                 timeout=self.timeout).json()
+
+    def exchange_code(self, code, redirect_uri='postmessage'):
+        """
+        Exchanges the one-time authorization code from the sign-in button
+        for tokens. Never retried - a code can be used only once.
+
+        :param code: Authorization code
+        :param redirect_uri: 'postmessage' for codes of the JavaScript client
+        :return: dict with access_token and id_token (or with 'error')
+        """
+        try:
+            with timed('http'):
+                response = self.http.post(self.token_url, data={
+                    'grant_type': 'authorization_code',
+                    'code': code,
+                    'client_id': self.client_id,
+                    'client_secret': self.client_secret,
+                    'redirect_uri': redirect_uri,
+                }, timeout=self.timeout)
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            return {'error': str(e)}
+
+        if 'access_token' not in result:
+            result.setdefault('error', 'no access token')
+        return result
+
+    def tokeninfo(self, access_token):
+        """
+        :return: dict with info about the access token (or with 'error')
+        """
+        return self.get_json(self.tokeninfo_url,
+                             {'access_token': access_token})
+
+    def userinfo(self, access_token):
+        """
+        :return: dict with user's profile - name, email, picture
+        """
+        return self.get_json(self.userinfo_url,
+                             {'access_token': access_token, 'alt': 'json'})
+
+    def revoke(self, access_token):
+        """
+        :return: True if the token was revoked
+        """
+        with timed('http'):
+            response = self.http.get(self.revoke_url,
+                                     params={'token': access_token},
+                                     timeout=self.timeout)
+        return response.status_code == 200
+
+    def certs(self):
+        """
+        Google's public certificates signing id tokens. Cached for as long as
+        Google's Cache-Control header allows.
+
+        :return: dict key id -> PEM certificate
+        """
+        with self._certs_lock:
+            if self._certs is None or self._certs_expire < time.time():
+                with timed('http'):
+                    response = self.http.get(self.certs_url,
+                                             timeout=self.timeout)
+                response.raise_for_status()
+
+                max_age = DEFAULT_CERTS_MAX_AGE
+                match = re.search(r'max-age=(\d+)',
+                                  response.headers.get('Cache-Control', ''))
+                if match:
+                    max_age = int(match.group(1))
+
+                self._certs = response.json()
+                self._certs_expire = time.time() + max_age
+
+            return self._certs
+
+    def verify_id_token(self, id_token):
+        """
+        Verifies signature, audience and expiration of the id token locally,
+        with cached certificates - no call to the tokeninfo endpoint.
+
+        :param id_token: Encoded id token (JWT) from the token response
+        :return: dict with token's claims or None if it can't be verified
+        """
+        try:
+            return crypt.verify_signed_jwt_with_certs(id_token, self.certs(),
+                                                      self.client_id)
+        except (crypt.AppIdentityError, requests.RequestException,
+                ValueError):
+            return None
+
+
+def id_token_subject(id_token):
+    """
+    Reads the user id from the id token without verifying it - it's only
+    compared with the verified user id of the access token.
+
+    :param id_token: Encoded id token (JWT)
+    :return: Google user id or None if the token can't be read
+    """
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['sub']
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,162 @@
+import json
+from collections import OrderedDict
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:
+    # optional (pip3 install orjson) - the standard library encoder is used
+    # without it
+    orjson = None
+
+from images import picture_variants
+from model import Category, Item, format_price
+
+##
+# SCHEMAS
+##
+
+
+class Schema(object):
+    """
+    Fields of serialized records of a model - the name, the model's column
+    the value is read from and an optional function converting the value.
+    Listings select just the columns of the requested fields and serialize
+    plain rows, no ORM objects are built.
+    """
+
+    def __init__(self, *fields):
+        """
+        :param fields: tuples (name, column[, convert])
+        """
+        self.fields = OrderedDict(
+                (field[0], (field[1], field[2] if len(field) > 2 else None))
+                for field in fields)
+
+    def parse_fields(self, value):
+        """
+        Reads selection of fields sent by the client (?fields=id,name).
+
+        :param value: Comma separated names, None or empty selects all fields
+        :return: tuple of names or None if some of them is unknown
+        """
+        if not value:
+            return tuple(self.fields)
+
+        names = tuple(OrderedDict.fromkeys(
+                name.strip() for name in value.split(',')))
+        if not set(names) <= set(self.fields):
+            return None
+
+        return names
+
+    def serializer(self, names=None, keys=()):
+        """
+        :param names: Fields to serialize, None serializes all of them
+        :param keys: Columns selected before the fields - see RowSerializer
+        :return: RowSerializer
+        """
+        return RowSerializer(self, names or tuple(self.fields), keys)
+
+    def dump(self, record, names=None):
+        """
+        Serializes an ORM object - for single records the view loaded anyway.
+
+        :param record: Instance of the model
+        :param names: Fields to serialize, None serializes all of them
+        :return: dict
+        """
+        result = {}
+        for name in names or self.fields:
+            column, convert = self.fields[name]
+            value = getattr(record, column.key)
+            result[name] = value if convert is None else convert(value)
+
+        return result
+
+
+class RowSerializer(object):
+    """
+    Builds dicts from rows selected with it's columns. Values are picked from
+    the row by a single itemgetter call, only the fields with a conversion
+    are touched one by one.
+    """
+
+    def __init__(self, schema, names, keys=()):
+        """
+        :param schema: Schema of the model
+        :param names: Fields to serialize
+        :param keys: Columns selected before the fields, e.g. the id used as
+                     the cursor of the pagination even if the client didn't
+                     ask for it
+        """
+        self.names = names
+        self.columns = list(keys)
+
+        positions = {column.key: index
+                     for index, column in enumerate(self.columns)}
+        indexes = []
+        self.converters = []
+
+        for name in names:
+            column, convert = schema.fields[name]
+            if column.key not in positions:
+                positions[column.key] = len(self.columns)
+                self.columns.append(column)
+
+            indexes.append(positions[column.key])
+            if convert is not None:
+                self.converters.append((name, convert))
+
+        if len(indexes) == 1:
+            index = indexes[0]
+            self._values = lambda row: (row[index],)
+        else:
+            self._values = itemgetter(*indexes)
+
+    def __call__(self, row):
+        result = dict(zip(self.names, self._values(row)))
+
+        # replacing a value keeps the order of the keys
+        for name, convert in self.converters:
+            result[name] = convert(result[name])
+
+        return result
+
+
+CATEGORY_SCHEMA = Schema(
+        ('id', Category.id),
+        ('name', Category.name),
+        ('description', Category.description),
+        ('picture', Category.picture),
+        ('pictures', Category.picture, picture_variants),
+        ('item_count', Category.item_count),
+        ('items_updated_at', Category.items_updated_at))
+
+ITEM_SCHEMA = Schema(
+        ('id', Item.id),
+        ('name', Item.name),
+        ('price', Item.price_cents, format_price),
+        ('description', Item.description),
+        ('picture', Item.picture),
+        ('pictures', Item.picture, picture_variants),
+        ('user_id', Item.user_id),
+        ('category_id', Item.category_id))
+
+
+##
+# JSON ENCODING
+##
+
+
+def dumps(data):
+    """
+    Encodes data as compact JSON - with orjson if it's installed, which is
+    several times faster than the standard library encoder.
+
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,196 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+##
+# SESSION STORES
+##
+# Any object with get(key), set(key, value, timeout) and delete(key) can
+# store sessions - e.g. cache.LRUBackend keeps them in the process's memory
+# (only for a single worker process), cache.SharedBackend in redis.
+
+
+class SQLiteSessionStore(object):
+    """
+    Sessions kept in a SQLite file - shared by all worker processes on the
+    host and kept over restarts. Expired sessions are deleted every
+    purge_interval seconds. Every thread has it's own connection.
+    """
+
+    def __init__(self, path, purge_interval=300, busy_timeout=5):
+        """
+        :param path: Path of the database file, created if it doesn't exist
+        :param purge_interval: Seconds between deletions of expired sessions
+        :param busy_timeout: Seconds to wait for the write lock
+        """
+        self.path = path
+        self.purge_interval = purge_interval
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._next_purge = 0
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+
+        # a forked worker opens it's own connection
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path,
+                                         timeout=self.busy_timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS session ('
+                               'id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                               'expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS '
+                               'ix_session_expires ON session (expires)')
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute(
+                'SELECT data FROM session WHERE id = ? AND expires > ?',
+                (key, time.time())).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, key, value, timeout=None):
+        now = time.time()
+        connection = self._connect()
+
+        connection.execute(
+                'INSERT OR REPLACE INTO session (id, data, expires) '
+                'VALUES (?, ?, ?)',
+                (key, value, now + timeout if timeout else float('inf')))
+
+        if now >= self._next_purge:
+            self._next_purge = now + self.purge_interval
+            connection.execute('DELETE FROM session WHERE expires <= ?',
+                               (now,))
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM session WHERE id = ?', (key,))
+
+
+##
+# SERVER-SIDE SESSION
+##
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    Session data loaded from the store. Only it's id travels in the cookie.
+    """
+
+    def __init__(self, initial=None, sid=None, saved_at=0.0, loaded=True):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.saved_at = saved_at
+        # sessions of requests for static files are not loaded nor saved
+        self.loaded = loaded
+        self.old_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        """
+        Moves the session under a new id, e.g. on login - an id somebody
+        learned before can't be used to take over the signed in session.
+        """
+        if self.sid is not None and self.old_sid is None:
+            self.old_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Keeps login sessions in a store on the server. The cookie holds a random
+    opaque id only, so it's small and nothing has to be signed or verified
+    on every request. Sessions unused for ttl seconds expire - a session
+    read by a request is written back when half of it's ttl has passed.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=7 * 24 * 3600, skip_paths=()):
+        """
+        :param store: Session store - see SQLiteSessionStore
+        :param ttl: Seconds an unused session is kept
+        :param skip_paths: Path prefixes not using the session (static
+                           files), the store is not asked for them
+        """
+        self.store = store
+        self.ttl = ttl
+        self.skip_paths = tuple(skip_paths)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+
+        # the session is opened before the url is matched, so the endpoint
+        # isn't known yet - static requests are told apart by their path
+        if self.skip_paths and request.path.startswith(self.skip_paths):
+            return ServerSession(sid=sid, loaded=False)
+
+        if not sid or len(sid) > 64:
+            return ServerSession()
+
+        value = self.store.get(sid)
+        if value is None:
+            # expired or unknown - the cookie is removed
+            session = ServerSession()
+            session.modified = True
+            return session
+
+        stored = self.serializer.loads(value)
+        return ServerSession(stored['data'], sid=sid,
+                             saved_at=stored['saved_at'])
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.old_sid is not None:
+            self.store.delete(session.old_sid)
+
+        if not session:
+            if session.modified:
+                if session.sid is not None:
+                    self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        now = time.time()
+        if session.sid is not None and not session.modified and \
+                now - session.saved_at < self.ttl / 2:
+            return
+
+        new_sid = session.sid is None
+        if new_sid:
+            session.sid = secrets.token_urlsafe(32)
+
+        self.store.set(session.sid, self.serializer.dumps(
+                {'saved_at': now, 'data': dict(session)}), self.ttl)
+
+        if new_sid or session.permanent:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app,
+                                                                 session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
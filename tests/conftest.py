@@ -0,0 +1,144 @@
+"""
+Fixtures shared by the tests - one app on a temporary database for the
+whole run, with Google's OAuth endpoints replaced by a local stub server
+(GOOGLE_*_URL settings).
+"""
+import base64
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the app's modules live in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+from model import Category, Item, User  # noqa: E402
+
+##
+# GOOGLE STUB
+##
+
+
+class GoogleStub(BaseHTTPRequestHandler):
+    """
+    Answers every path with the JSON set in responses. Requests are recorded
+    as (method, path, body).
+    """
+    protocol_version = 'HTTP/1.1'
+    responses = {}
+    requests = []
+
+    def reply(self, body):
+        self.requests.append((self.command, self.path.split('?')[0], body))
+        data = json.dumps(self.responses[self.path.split('?')[0]]).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.reply(self.rfile.read(length).decode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def google():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GoogleStub)
+    # the app keeps connections open - they must not block the shutdown
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+
+    server.shutdown()
+
+
+##
+# APP
+##
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory, google):
+    folder = tmp_path_factory.mktemp('app')
+    uploads = folder / 'uploads'
+    uploads.mkdir()
+
+    flask_app = app_module.create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'CLIENT_ID': 'test-client',
+        'CLIENT_SECRET': 'test-secret',
+        'DATABASE_URL': 'sqlite:///{}'.format(folder / 'test.db'),
+        'DATABASE_MIGRATE': True,
+        'SQL_QUERY_BUDGET_STRICT': True,
+        'SESSION_STORE': 'memory',
+        'TEMPLATE_CACHE_FOLDER': None,
+        'UPLOAD_FOLDER': str(uploads),
+        'GOOGLE_TOKEN_URL': google + '/token',
+        'GOOGLE_TOKENINFO_URL': google + '/tokeninfo',
+        'GOOGLE_USERINFO_URL': google + '/userinfo',
+        'GOOGLE_REVOKE_URL': google + '/revoke',
+        'GOOGLE_CERTS_URL': google + '/certs',
+    })
+
+    # a few records of every kind, so a query per record would show
+    session = app_module.DBSession()
+    user = User(username='owner', email='owner@example.com', picture='')
+    session.add(user)
+    session.flush()
+
+    for number in range(3):
+        category = Category(name='Category {}'.format(number),
+                            description='Description', user_id=user.id)
+        session.add(category)
+        session.flush()
+
+        for item_number in range(5):
+            session.add(Item(name='Item {}'.format(item_number),
+                             description='Description',
+                             price_cents=100 * item_number,
+                             category_id=category.id, user_id=user.id))
+
+    session.commit()
+    session.close()
+
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    """
+    Test client signed in as the owner of the records.
+    """
+    client = app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['username'] = 'owner'
+        login_session['email'] = 'owner@example.com'
+        login_session['picture'] = ''
+        login_session['user_id'] = 1
+    return client
+
+
+@pytest.fixture
+def api_headers(app):
+    """
+    Basic Auth headers with an API token of the owner of the records.
+    """
+    with app.app_context():
+        token = User(id=1).generate_auth_token().decode('ascii')
+    credentials = base64.b64encode((token + ':').encode('ascii'))
+    return {'Authorization': 'Basic ' + credentials.decode('ascii')}
@@ -0,0 +1,73 @@
+"""
+Tests of the views against a temporary database - see conftest.py.
+
+    python3 -m pytest tests/
+"""
+import base64
+
+import pytest
+from itsdangerous import TimedJSONWebSignatureSerializer
+
+import app as app_module
+
+##
+# QUERY BUDGETS
+##
+
+
+@pytest.mark.parametrize('url, budget', [
+    ('/', 1),
+    ('/category/1/', 2),
+    ('/category/2/?sort=price&min_price=1', 2),
+])
+def test_view_query_budget(client, url, budget):
+    app_module.response_cache.invalidate('categories', 'category:1',
+                                         'category:2')
+
+    response = client.get(url)
+
+    assert response.status_code == 200
+    assert int(response.headers['X-SQL-Query-Count']) <= budget
+
+
+def test_cached_view_runs_no_query(client):
+    client.get('/category/1/')
+    response = client.get('/category/1/')
+
+    assert response.status_code == 200
+    assert response.headers['X-SQL-Query-Count'] == '0'
+
+
+##
+# READ REPLICAS
+##
+
+
+@pytest.mark.parametrize('url, use_replica', [
+    ('/category/1/', True),
+    ('/category/1/delete/', False),
+    ('/category/1/item/1/delete/', False),
+    ('/logout', False),
+])
+def test_views_changing_data_read_from_primary(app, url, use_replica):
+    with app.test_request_context(url):
+        app_module.route_reads()
+        assert app_module.session.info['use_replica'] is use_replica
+        app_module.session.remove()
+
+
+##
+# API TOKENS
+##
+
+
+def test_api_token_signed_with_configured_key(client):
+    token = client.get('/token').get_json()['token']
+
+    # signed with the SECRET_KEY passed to create_app()
+    assert TimedJSONWebSignatureSerializer('test').loads(token) == {'id': 1}
+
+    auth = base64.b64encode((token + ':').encode()).decode()
+    response = client.get('/api/v1/categories/',
+                          headers={'Authorization': 'Basic ' + auth})
+    assert response.status_code == 200
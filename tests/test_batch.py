@@ -0,0 +1,118 @@
+"""
+Batch API - getting, updating and deleting many items in one request.
+"""
+import pytest
+
+import app as app_module
+from model import Category, Item, Tombstone
+
+
+@pytest.fixture
+def records(app):
+    """
+    Two categories of their own, the first with three items.
+
+    :return: tuple (category ids, item ids)
+    """
+    session = app_module.DBSession()
+    categories = [Category(name='Batch {}'.format(number), description='',
+                           user_id=1) for number in range(2)]
+    session.add_all(categories)
+    session.flush()
+
+    items = [Item(name='Batch item {}'.format(number), description='Kept',
+                  price_cents=100, category_id=categories[0].id, user_id=1)
+             for number in range(3)]
+    session.add_all(items)
+    session.flush()
+    categories[0].item_count = len(items)
+    session.commit()
+
+    ids = [category.id for category in categories], \
+        [item.id for item in items]
+    session.close()
+    return ids
+
+
+def post(client, headers, method, body):
+    return client.post('/api/v1/items:' + method, json=body,
+                       headers=headers).get_json()
+
+
+def test_batch_get(client, api_headers, records):
+    __, (first, second, __) = records
+
+    data = client.post('/api/v1/items:batchGet?fields=id,name',
+                       json={'ids': [second, 999999, first, second]},
+                       headers=api_headers).get_json()
+
+    # in the order of the ids, without duplicates
+    assert data['results'] == [
+        {'id': second, 'ok': True,
+         'item': {'id': second, 'name': 'Batch item 1'}},
+        {'id': 999999, 'ok': False,
+         'error': 'There is no item with id: 999999.'},
+        {'id': first, 'ok': True,
+         'item': {'id': first, 'name': 'Batch item 0'}},
+    ]
+
+
+@pytest.mark.parametrize('body, error', [
+    ({}, 'Expected a non-empty list of ids.'),
+    ({'ids': []}, 'Expected a non-empty list of ids.'),
+    ({'ids': [1, '2']}, 'Invalid id: "2".'),
+    ({'ids': list(range(1, 502))},
+     'At most 500 ids are allowed in one request.'),
+])
+def test_batch_invalid_ids(client, api_headers, body, error):
+    for method in ('batchGet', 'batchDelete'):
+        assert post(client, api_headers, method, body) == {'error': error}
+
+
+def test_batch_update(client, api_headers, records):
+    (source, target), (first, second, __) = records
+
+    data = post(client, api_headers, 'batchUpdate', {'items': [
+        {'id': first, 'name': 'Renamed'},
+        {'id': second, 'price': '2.50', 'category_id': target},
+        {'id': 999999, 'name': 'Missing'},
+        {'id': first, 'name': 'Twice'},
+    ]})
+
+    assert [result['ok'] for result in data['results']] == \
+        [True, True, False, False]
+
+    session = app_module.DBSession()
+    renamed, moved = session.query(Item).filter(
+            Item.id.in_([first, second])).order_by(Item.id)
+    # only the fields of the patch are changed
+    assert (renamed.name, renamed.description, renamed.price_cents) == \
+        ('Renamed', 'Kept', 100)
+    assert (moved.name, moved.price_cents, moved.category_id) == \
+        ('Batch item 1', 250, target)
+    assert [category.item_count for category in session.query(Category)
+            .filter(Category.id.in_([source, target]))
+            .order_by(Category.id)] == [2, 1]
+    session.close()
+
+
+def test_batch_delete(client, api_headers, records):
+    (category_id, __), (first, __, third) = records
+
+    data = post(client, api_headers, 'batchDelete',
+                {'ids': [first, 999999, third]})
+
+    assert [result['ok'] for result in data['results']] == \
+        [True, False, True]
+    assert [result['ok'] for result in post(
+            client, api_headers, 'batchGet',
+            {'ids': [first, third]})['results']] == [False, False]
+
+    session = app_module.DBSession()
+    # the change feed learns about the deletion
+    assert sorted(record_id for record_id, in session.query(
+            Tombstone.record_id).filter_by(kind='item',
+                                           category_id=category_id)) == \
+        [first, third]
+    assert session.query(Category).get(category_id).item_count == 1
+    session.close()
@@ -0,0 +1,86 @@
+"""
+Bulk import (NDJSON or CSV) and the NDJSON export of the catalogue.
+"""
+import json
+
+import app as app_module
+from model import Category
+
+PICTURE = 'b' * 64 + '.png'
+
+
+def lines(*records):
+    return ''.join((record if isinstance(record, str) else
+                    json.dumps(record)) + '\n' for record in records)
+
+
+def test_import_ndjson(client, api_headers):
+    body = lines(
+        {'type': 'category', 'id': 900001, 'name': 'Imported'},
+        {'type': 'item', 'name': 'First', 'price': '1.50',
+         'category_id': 900001},
+        {'type': 'item', 'name': 'Second', 'category_id': 900001},
+        'not json',
+        {'type': 'user', 'name': 'Nobody'},
+        {'type': 'item', 'category_id': 900001},
+        {'type': 'item', 'name': 'Cheap', 'price': 'free',
+         'category_id': 900001},
+        {'type': 'item', 'name': 'Lost', 'category_id': 999999},
+        {'type': 'category', 'name': 'Path', 'picture': '../app.py'},
+        {'type': 'category', 'name': 'Missing', 'picture': PICTURE},
+        {'type': 'category', 'id': 900001, 'name': 'Twice'},
+    )
+
+    report = client.post('/api/v1/bulk', data=body,
+                         headers=api_headers).get_json()
+
+    assert (report['categories'], report['items']) == (1, 2)
+    errors = [(error['line'], error['error']) for error in report['errors']]
+    assert errors[:-1] == [
+        (4, 'Invalid record.'),
+        (5, 'Unknown type: user.'),
+        (6, 'Missing name.'),
+        (7, 'Invalid price.'),
+        (8, 'There is no category with id: 999999.'),
+        (9, 'Invalid picture.'),
+        (10, 'There is no uploaded picture: {}.'.format(PICTURE)),
+    ]
+    # the rest of the batch is inserted, only the duplicate is reported
+    assert errors[-1][0] == 11
+    assert 'UNIQUE' in errors[-1][1]
+
+    session = app_module.DBSession()
+    category = session.query(Category).get(900001)
+    assert (category.name, category.item_count) == ('Imported', 2)
+    session.close()
+
+
+def test_import_csv(client, api_headers):
+    body = ('type,id,name,price,category_id\n'
+            'category,900002,From CSV,,\n'
+            'item,,Priced,12.50,900002\n')
+
+    report = client.post('/api/v1/bulk', data=body, headers=dict(
+            api_headers, **{'Content-Type': 'text/csv'})).get_json()
+
+    assert report == {'categories': 1, 'items': 1, 'errors': []}
+
+
+def test_export(client, api_headers):
+    client.post('/api/v1/bulk', headers=api_headers, data=lines(
+        {'type': 'category', 'id': 900003, 'name': 'Exported'},
+        {'type': 'item', 'name': 'Exported item', 'price': '0.99',
+         'category_id': 900003}))
+
+    response = client.get('/api/v1/export', headers=api_headers)
+
+    assert response.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.data.splitlines()]
+    # categories first, so the export can be imported again
+    kinds = [record['type'] for record in records]
+    assert kinds == sorted(kinds)
+    assert {'type': 'category', 'id': 900003, 'name': 'Exported',
+            'description': None, 'picture': None} in records
+    item, = [record for record in records
+             if record.get('category_id') == 900003]
+    assert (item['name'], item['price']) == ('Exported item', '0.99')
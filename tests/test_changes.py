@@ -0,0 +1,84 @@
+"""
+Change feed - cursors, paging through changes and tombstones of deleted
+records.
+"""
+import pytest
+
+import app as app_module
+from changes import FEED_MODELS, format_cursor, parse_cursor
+from model import Category, Item
+
+
+def test_parse_cursor():
+    assert parse_cursor(None) == (0, -1, 0)
+    assert parse_cursor('') == (0, -1, 0)
+    # a plain version skips everything of that version
+    assert parse_cursor('7') == (7, len(FEED_MODELS), 0)
+    assert parse_cursor('7.1.42') == (7, 1, 42)
+    assert parse_cursor(format_cursor((7, 2, 3))) == (7, 2, 3)
+
+
+@pytest.mark.parametrize('cursor', [
+    'abc', '1.2', '1.2.3.4', '1.-1.3', '1..3', '7.1.x',
+])
+def test_parse_invalid_cursor(cursor):
+    assert parse_cursor(cursor) is None
+
+
+def read_feed(client, headers, cursor, limit):
+    """
+    Follows the feed from the cursor to it's end.
+
+    :return: tuple (changes, cursor of the last one)
+    """
+    changes = []
+    while True:
+        url = '/api/v1/changes?limit={}'.format(limit)
+        if cursor:
+            url += '&since=' + cursor
+        page = client.get(url, headers=headers).get_json()
+        changes.extend(page['changes'])
+        cursor = page['cursor']
+        if not page['has_more']:
+            return changes, cursor
+
+
+def test_feed_pages_through_changes(client, api_headers):
+    __, start = read_feed(client, api_headers, None, 1000)
+
+    session = app_module.DBSession()
+    category = Category(name='Feed', description='', user_id=1)
+    session.add(category)
+    session.flush()
+    kept = Item(name='Kept', category_id=category.id, user_id=1)
+    deleted = Item(name='Deleted', category_id=category.id, user_id=1)
+    session.add_all([kept, deleted])
+    session.commit()
+
+    kept.name = 'Renamed'
+    session.commit()
+    session.delete(deleted)
+    session.commit()
+    ids = category.id, kept.id, deleted.id
+    session.close()
+
+    changes, end = read_feed(client, api_headers, start, 1000)
+    # every change is seen once, whatever the page size
+    assert read_feed(client, api_headers, start, 1) == (changes, end)
+    # nothing after the last cursor
+    assert read_feed(client, api_headers, end, 1000) == ([], end)
+
+    versions = [change['version'] for change in changes]
+    assert versions == sorted(versions)
+
+    records = {(change['type'], change['id']): change for change in changes}
+    category_id, kept_id, deleted_id = ids
+    assert records['category', category_id]['deleted'] is False
+    assert records['item', kept_id]['item']['name'] == 'Renamed'
+    assert records['item', deleted_id]['deleted'] is True
+
+
+def test_invalid_cursor(client, api_headers):
+    response = client.get('/api/v1/changes?since=1.2', headers=api_headers)
+
+    assert 'error' in response.get_json()
@@ -0,0 +1,78 @@
+"""
+Conditional requests - JSON APIs and uploaded files answer with 304 Not
+Modified when the client's copy is current.
+"""
+import os
+
+import app as app_module
+from model import Category, Item
+
+
+def create_item():
+    """
+    :return: tuple (category id, item id) of a new item
+    """
+    session = app_module.DBSession()
+    category = Category(name='Conditional', description='', user_id=1)
+    session.add(category)
+    session.flush()
+    item = Item(name='Conditional', description='', category_id=category.id,
+                user_id=1)
+    session.add(item)
+    session.commit()
+
+    ids = category.id, item.id
+    session.close()
+    return ids
+
+
+def test_api_not_modified(client, api_headers):
+    category_id, item_id = create_item()
+    url = '/api/v1/category/{}/item/{}'.format(category_id, item_id)
+
+    response = client.get(url, headers=api_headers)
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+    response = client.get(url, headers=dict(api_headers,
+                                            **{'If-None-Match': etag}))
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    client.post('/api/v1/items:batchUpdate', headers=api_headers,
+                json={'items': [{'id': item_id, 'name': 'Changed'}]})
+
+    response = client.get(url, headers=dict(api_headers,
+                                            **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['item']['name'] == 'Changed'
+
+
+def test_api_etag_depends_on_arguments(client, api_headers):
+    url = '/api/v1/categories/'
+
+    first = client.get(url + '?limit=1', headers=api_headers)
+    second = client.get(url + '?limit=2', headers=api_headers)
+
+    assert first.headers['ETag'] != second.headers['ETag']
+
+
+def test_upload_not_modified(app, client):
+    filename = 'a' * 64 + '.png'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+    url = '/static/uploads/' + filename
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"{}"'.format(filename)
+    assert 'immutable' in response.headers['Cache-Control']
+    response.close()
+
+    response = client.get(url, headers={'If-None-Match': '"{}"'.format(
+            filename)})
+    assert response.status_code == 304
+    assert response.data == b''
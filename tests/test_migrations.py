@@ -0,0 +1,52 @@
+"""
+Schema migrations and the check of query plans of the hot queries.
+"""
+import os
+import shutil
+
+from sqlalchemy import text
+
+from database import create_db_engine
+from migrations import MIGRATIONS, check_query_plans, migrate
+
+# the database shipped with the app has the original schema
+SHIPPED_DATABASE = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'itemsapp.db')
+
+
+def test_new_database_queries_use_indexes(tmp_path):
+    engine = create_db_engine('sqlite:///{}'.format(tmp_path / 'new.db'))
+
+    assert migrate(engine) == [migration.__name__
+                               for migration in MIGRATIONS]
+    assert migrate(engine) == []
+    assert check_query_plans(engine) == []
+
+
+def test_missing_index_is_reported(tmp_path):
+    engine = create_db_engine('sqlite:///{}'.format(tmp_path / 'new.db'))
+    migrate(engine)
+
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_item_user_id'))
+
+    assert check_query_plans(engine) == [
+        "'items of user' scans the whole 'item' table."]
+
+
+def test_upgraded_database_queries_use_indexes(tmp_path):
+    shutil.copy(SHIPPED_DATABASE, str(tmp_path / 'old.db'))
+    engine = create_db_engine('sqlite:///{}'.format(tmp_path / 'old.db'))
+
+    migrate(engine)
+
+    assert check_query_plans(engine) == []
+    with engine.connect() as connection:
+        # text prices are converted to cents
+        assert connection.execute(text(
+                'SELECT price_cents FROM item WHERE id = 1')).scalar() == 3000
+        # search index triggers fire only on changes of indexed columns
+        trigger = connection.execute(text(
+                "SELECT sql FROM sqlite_master "
+                "WHERE name = 'item_search_update'")).scalar()
+        assert 'UPDATE OF name, description, category_id' in trigger
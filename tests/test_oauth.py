@@ -0,0 +1,94 @@
+"""
+Google Sign-In against the local stub of Google's endpoints - see
+conftest.py.
+"""
+import base64
+import json
+
+from conftest import GoogleStub
+from oauth import id_token_subject
+
+
+def encode_id_token(claims):
+    """
+    :return: Unsigned JWT with given claims - the stub serves no certs, so
+             the app falls back to the tokeninfo endpoint
+    """
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode())
+    return 'header.{}.signature'.format(payload.decode().rstrip('='))
+
+
+def sign_in(app, code, responses):
+    GoogleStub.responses = responses
+    GoogleStub.requests = []
+
+    client = app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['state'] = 'STATE'
+
+    response = client.post('/gconnect?state=STATE', data=code)
+    return client, response
+
+
+def google_responses(client_id='test-client'):
+    return {
+        '/token': {'access_token': 'access',
+                   'id_token': encode_id_token({'sub': '42'})},
+        '/certs': {},
+        '/tokeninfo': {'issued_to': client_id, 'user_id': '42'},
+        '/userinfo': {'name': 'Signed', 'email': 'signed@example.com',
+                      'picture': 'https://example.com/signed.png'},
+    }
+
+
+def test_sign_in_exchanges_code(app):
+    client, response = sign_in(app, b'CODE', google_responses())
+
+    assert response.status_code == 200
+    method, path, body = GoogleStub.requests[0]
+    assert (method, path) == ('POST', '/token')
+    assert 'code=CODE' in body and 'client_secret=test-secret' in body
+
+    with client.session_transaction() as login_session:
+        assert login_session['gplus_id'] == '42'
+        assert login_session['email'] == 'signed@example.com'
+        assert login_session['user_id'] is not None
+
+    assert client.get('/').status_code == 200
+
+
+def test_sign_in_rejects_failed_exchange(app):
+    responses = google_responses()
+    responses['/token'] = {'error': 'invalid_grant'}
+
+    client, response = sign_in(app, b'USED', responses)
+
+    assert response.status_code == 401
+    assert [path for _, path, _ in GoogleStub.requests] == ['/token']
+
+
+def test_sign_in_rejects_token_of_other_client(app):
+    client, response = sign_in(app, b'CODE', google_responses('other'))
+
+    assert response.status_code == 401
+    with client.session_transaction() as login_session:
+        assert 'user_id' not in login_session
+
+
+def test_sign_out_revokes_token(app):
+    client, response = sign_in(app, b'CODE', google_responses())
+    GoogleStub.responses['/revoke'] = {}
+    GoogleStub.requests = []
+
+    response = client.get('/logout')
+
+    assert response.status_code == 302
+    assert [path for _, path, _ in GoogleStub.requests] == ['/revoke']
+    with client.session_transaction() as login_session:
+        assert 'access_token' not in login_session
+
+
+def test_id_token_subject():
+    assert id_token_subject(encode_id_token({'sub': '42'})) == '42'
+    assert id_token_subject('not a token') is None
+    assert id_token_subject(None) is None
@@ -0,0 +1,70 @@
+"""
+Prices stored as integer cents - parsing, formatting and the price filters
+of item listings.
+"""
+from decimal import Decimal
+
+import pytest
+
+from model import MAX_PRICE_CENTS, format_price, parse_price
+
+
+@pytest.mark.parametrize('value, cents', [
+    ('12.50', 1250),
+    ('12.5', 1250),
+    (' 30 ', 3000),
+    (12, 1200),
+    (0.1, 10),
+    (Decimal('9.99'), 999),
+    ('0.005', 1),
+    ('0.004', 0),
+    ('0', 0),
+])
+def test_parse_price(value, cents):
+    assert parse_price(value) == cents
+
+
+@pytest.mark.parametrize('value', [
+    '', 'abc', '-1', 'NaN', 'Infinity', '1e400', True, None,
+    str(MAX_PRICE_CENTS // 100 + 1),
+])
+def test_parse_invalid_price(value):
+    assert parse_price(value) is None
+
+
+@pytest.mark.parametrize('cents, text', [
+    (1250, '12.50'), (5, '0.05'), (0, '0.00'), (None, None),
+])
+def test_format_price(cents, text):
+    assert format_price(cents) == text
+
+
+def test_items_filtered_and_ordered_by_price(client, api_headers):
+    response = client.get('/api/v1/category/2?min_price=1&max_price=3.00'
+                          '&sort=price&fields=id,price', headers=api_headers)
+
+    assert response.get_json()['items'] == [
+        {'id': 7, 'price': '1.00'},
+        {'id': 8, 'price': '2.00'},
+        {'id': 9, 'price': '3.00'},
+    ]
+
+
+def test_items_paged_by_price(client, api_headers):
+    response = client.get('/api/v1/category/2?sort=price&limit=2&fields=id',
+                          headers=api_headers)
+    page = response.get_json()
+    assert [item['id'] for item in page['items']] == [6, 7]
+
+    response = client.get(page['next'], headers=api_headers)
+    assert [item['id'] for item in response.get_json()['items']] == [8, 9]
+
+
+@pytest.mark.parametrize('query', [
+    'min_price=abc', 'max_price=-1', 'sort=name', 'after_price=x',
+])
+def test_invalid_price_filter(client, api_headers, query):
+    response = client.get('/api/v1/category/2?' + query, headers=api_headers)
+
+    assert response.get_json() == {
+        'error': 'Invalid price filter or sort order.'}
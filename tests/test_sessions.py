@@ -0,0 +1,145 @@
+"""
+Server-side sessions - the cookie carries an opaque id of the session kept
+in a store.
+"""
+import pytest
+from flask import Flask, session
+
+from sessions import SQLiteSessionStore, ServerSessionInterface
+
+
+def test_sqlite_store(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    store = SQLiteSessionStore(path)
+
+    store.set('a', 'first', 60)
+    store.set('b', 'second', -1)
+    store.set('c', 'forever')
+
+    # shared by all processes using the file
+    other = SQLiteSessionStore(path)
+    assert other.get('a') == 'first'
+    assert other.get('b') is None
+    assert other.get('c') == 'forever'
+
+    other.delete('a')
+    assert store.get('a') is None
+
+
+class RecordingStore(object):
+    """
+    Session store in a dict, recording names of the called methods.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.calls.append('set')
+        self.data[key] = value
+
+    def delete(self, key):
+        self.calls.append('delete')
+        self.data.pop(key, None)
+
+
+@pytest.fixture
+def store():
+    return RecordingStore()
+
+
+@pytest.fixture
+def session_client(store):
+    """
+    Test client of a minimal app keeping it's sessions in the store.
+    """
+    flask_app = Flask(__name__)
+    flask_app.session_interface = ServerSessionInterface(
+            store, skip_paths=('/static/',))
+
+    @flask_app.route('/set/<value>')
+    def set_value(value):
+        session['value'] = value
+        return ''
+
+    @flask_app.route('/get')
+    def get_value():
+        return session.get('value', '')
+
+    @flask_app.route('/login')
+    def login():
+        session.regenerate()
+        return ''
+
+    @flask_app.route('/logout')
+    def logout():
+        session.clear()
+        return ''
+
+    return flask_app.test_client()
+
+
+def session_id(client):
+    cookies = [cookie for cookie in client.cookie_jar
+               if cookie.name == 'session']
+    return cookies[0].value if cookies else None
+
+
+def test_session_kept_on_server(session_client, store):
+    session_client.get('/set/secret')
+
+    sid = session_id(session_client)
+    assert list(store.data) == [sid]
+    assert 'secret' not in sid
+    assert session_client.get('/get').data == b'secret'
+
+
+def test_unchanged_session_not_saved(session_client, store):
+    session_client.get('/set/secret')
+    del store.calls[:]
+
+    session_client.get('/get')
+
+    assert store.calls == ['get']
+
+
+def test_static_path_skips_store(session_client, store):
+    session_client.get('/set/secret')
+    del store.calls[:]
+
+    assert session_client.get('/static/style.css').status_code == 404
+    assert store.calls == []
+    assert session_id(session_client) is not None
+
+
+def test_regenerate_moves_session(session_client, store):
+    session_client.get('/set/secret')
+    old_sid = session_id(session_client)
+
+    session_client.get('/login')
+
+    assert session_id(session_client) != old_sid
+    assert list(store.data) == [session_id(session_client)]
+    assert session_client.get('/get').data == b'secret'
+
+
+def test_cleared_session_deleted(session_client, store):
+    session_client.get('/set/secret')
+
+    session_client.get('/logout')
+
+    assert store.data == {}
+    assert session_id(session_client) is None
+
+
+def test_unknown_session(session_client, store):
+    session_client.get('/set/secret')
+    store.data.clear()
+
+    assert session_client.get('/get').data == b''
+    assert session_id(session_client) is None
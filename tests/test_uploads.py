@@ -0,0 +1,147 @@
+"""
+Uploaded pictures - streamed to disk and checked while they are received,
+stored under the SHA-256 of their content, deleted only when no record uses
+them.
+"""
+import hashlib
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+from uploads import UploadSpool, is_upload_name, remove_upload, \
+    store_upload, upload_path
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'not really pixels'
+
+
+def test_store_upload_by_content(tmp_path):
+    folder = str(tmp_path)
+
+    filename, created = store_upload(io.BytesIO(PNG), folder, '.PNG')
+
+    assert filename == hashlib.sha256(PNG).hexdigest() + '.png'
+    assert created
+    assert is_upload_name(filename)
+    assert os.listdir(folder) == [filename]
+
+
+def test_store_same_upload_once(tmp_path):
+    folder = str(tmp_path)
+    filename, __ = store_upload(io.BytesIO(PNG), folder, '.png')
+    os.utime(os.path.join(folder, filename), (0, 0))
+
+    assert store_upload(io.BytesIO(PNG), folder, '.png') == (filename, False)
+    assert os.listdir(folder) == [filename]
+    # touched, so a deletion queued before the upload skips it
+    assert os.path.getmtime(os.path.join(folder, filename)) > 0
+
+
+def test_upload_path(tmp_path):
+    folder = str(tmp_path)
+
+    assert upload_path(folder, 'picture.png') == \
+        os.path.join(folder, 'picture.png')
+    for filename in ('', '.hidden', '..', '../app.py', 'a/b.png'):
+        assert upload_path(folder, filename) is None
+
+
+def test_remove_upload(tmp_path):
+    folder = str(tmp_path)
+    filename, __ = store_upload(io.BytesIO(PNG), folder, '.png')
+    queued_at = time.time()
+
+    # uploaded again after the deletion was queued
+    assert not remove_upload(folder, filename, queued_at - 60)
+    assert os.listdir(folder) == [filename]
+
+    assert remove_upload(folder, filename, queued_at + 60)
+    assert os.listdir(folder) == []
+    assert not remove_upload(folder, '../test.db', queued_at + 60)
+
+
+##
+# STREAMED UPLOADS
+##
+
+
+def image_bytes(size=(4, 4)):
+    data = io.BytesIO()
+    Image.new('RGB', size).save(data, 'PNG')
+    return data.getvalue()
+
+
+def test_spool_stores_image(tmp_path):
+    data = image_bytes()
+    spool = UploadSpool(str(tmp_path), 1024)
+    spool.write(data[:3])
+    spool.write(data[3:])
+
+    filename, created = spool.store(100)
+
+    assert filename == hashlib.sha256(data).hexdigest() + '.png'
+    assert created
+    assert os.listdir(str(tmp_path)) == [filename]
+
+
+def test_spool_rejects_large_upload(tmp_path):
+    spool = UploadSpool(str(tmp_path), 10)
+
+    with pytest.raises(RequestEntityTooLarge):
+        spool.write(PNG)
+    # the rest isn't written anywhere
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spool_rejects_other_type(tmp_path):
+    spool = UploadSpool(str(tmp_path), 1024)
+
+    with pytest.raises(UnsupportedMediaType):
+        spool.write(b'<?php echo "hi"; ?>')
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spool_rejects_short_upload(tmp_path):
+    spool = UploadSpool(str(tmp_path), 1024)
+    spool.write(b'GIF')
+
+    with pytest.raises(UnsupportedMediaType):
+        spool.store(100)
+    spool.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('data, error', [
+    (PNG, UnsupportedMediaType),
+    (image_bytes((101, 1)), RequestEntityTooLarge),
+])
+def test_spool_checks_image(tmp_path, data, error):
+    spool = UploadSpool(str(tmp_path), 1024)
+    spool.write(data)
+
+    with pytest.raises(error):
+        spool.store(100)
+    spool.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('data, status', [
+    (b'x' * 2048, 413),
+    (b'plain text, not an image', 415),
+])
+def test_rejected_picture(app, client, monkeypatch, data, status):
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_SIZE', 1024)
+    folder = app.config['UPLOAD_FOLDER']
+    uploads = sorted(os.listdir(folder))
+
+    response = client.post('/category/add', data={
+        'name': 'Rejected',
+        'description': '',
+        'category-pic': (io.BytesIO(data), 'picture.png'),
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == status
+    assert sorted(os.listdir(folder)) == uploads
@@ -0,0 +1,487 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+
+from PIL import Image
+from flask import Request, Response, abort, current_app, request, safe_join
+from flask import send_file
+from werkzeug.security import safe_join as safe_path
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.urls import url_quote
+
+from images import all_variant_filenames
+from metrics import timed
+
+log = logging.getLogger(__name__)
+
+##
+# STREAMED UPLOADS
+##
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of accepted image formats -> extension of the stored file
+MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'\x00\x00\x01\x00', '.ico'),
+]
+MAGIC_LENGTH = max(len(magic) for magic, extension in MAGIC_NUMBERS)
+
+
+def sniff_extension(header):
+    """
+    Recognizes image format by it's leading bytes, not by the file name.
+
+    :param header: First bytes of the file
+    :return: Extension of the format (e.g. '.png') or None if not an image
+    """
+    for magic, extension in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return extension
+
+    return None
+
+
+class UploadSpool(object):
+    """
+    Writable file Werkzeug streams an uploaded file into while parsing the
+    request body. Chunks go straight to a temporary file in the uploads
+    folder and are hashed on the way, so the upload is never buffered in
+    memory or copied a second time. The upload is rejected as soon as it
+    exceeds max_size or it's first bytes aren't a known image format - the
+    rest of the body is not even written to disk.
+    """
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.size = 0
+        self.header = b''
+        self.extension = None
+        self.digest = hashlib.sha256()
+
+        fd, self.path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        self.file = os.fdopen(fd, 'w+b')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge(
+                    "Uploaded file is larger than {} bytes.".format(
+                            self.max_size))
+
+        if len(self.header) < MAGIC_LENGTH:
+            self.header += data[:MAGIC_LENGTH - len(self.header)]
+            if len(self.header) >= MAGIC_LENGTH:
+                self.check_type()
+
+        with timed('upload'):
+            self.digest.update(data)
+            self.file.write(data)
+
+    def check_type(self):
+        self.extension = sniff_extension(self.header)
+        if self.extension is None:
+            self.close()
+            raise UnsupportedMediaType("Uploaded file is not an image.")
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """
+        Closes the spool. The temporary file is removed unless it was already
+        moved into the uploads folder with store().
+        """
+        self.file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def store(self, max_dimension):
+        """
+        Validates the complete upload and atomically renames it into the
+        uploads folder, under the name derived from it's content.
+
+        :param max_dimension: Maximal width and height of the image
+        :return: tuple (file name, True if the file is new)
+        """
+        if self.extension is None:
+            # smaller than the longest magic number
+            self.check_type()
+
+        with timed('upload'):
+            self.file.close()
+            check_image(self.path, max_dimension)
+
+            filename = self.digest.hexdigest() + self.extension
+            path = os.path.join(self.folder, filename)
+
+            created = not os.path.exists(path)
+            if created:
+                os.replace(self.path, path)
+            else:
+                # the same content is already stored - touch it, so a queued
+                # deletion of the file is skipped
+                os.remove(self.path)
+                os.utime(path)
+
+        self.path = None
+        return filename, created
+
+
+def check_image(path, max_dimension):
+    """
+    Checks dimensions of the image. Pillow reads just the header here, the
+    pixels are not decoded.
+
+    :param path: Path of the image
+    :param max_dimension: Maximal width and height
+    """
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except (IOError, OSError, Image.DecompressionBombError):
+        raise UnsupportedMediaType("Uploaded file is not a valid image.")
+
+    if width > max_dimension or height > max_dimension:
+        raise RequestEntityTooLarge(
+                "Uploaded image is larger than {0}x{0} pixels.".format(
+                        max_dimension))
+
+
+class UploadRequest(Request):
+    """
+    Request streaming uploaded files into UploadSpools. Limits are read from
+    UPLOAD_FOLDER and UPLOAD_MAX_SIZE app config.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return UploadSpool(current_app.config['UPLOAD_FOLDER'],
+                           current_app.config['UPLOAD_MAX_SIZE'])
+
+
+##
+# CONTENT-ADDRESSED UPLOAD STORAGE
+##
+
+
+def store_upload(stream, folder, extension):
+    """
+    Saves uploaded file under the name derived from it's content (SHA-256).
+    The file is hashed while it's copied in chunks to a temporary file, so
+    it's never held in memory as a whole. Identical uploads share one file.
+
+    :param stream: Readable binary stream with the upload
+    :param folder: Folder with uploaded files
+    :param extension: Extension of the file, with leading dot (e.g. '.jpg')
+    :return: tuple (file name, True if the file is new)
+    """
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+
+    try:
+        with timed('upload'), os.fdopen(fd, 'wb') as tmp_file:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                tmp_file.write(chunk)
+
+        filename = digest.hexdigest() + extension.lower()
+        path = upload_path(folder, filename)
+        if path is None:
+            raise ValueError("Invalid extension: {}.".format(extension))
+
+        if os.path.exists(path):
+            # the same content is already stored
+            os.remove(tmp_path)
+            os.utime(path)
+            return filename, False
+
+        os.replace(tmp_path, path)
+        return filename, True
+
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def upload_path(folder, filename):
+    """
+    Path of the uploaded file in the folder.
+
+    :param folder: Folder with uploaded files
+    :param filename: Name of the file
+    :return: Path or None if filename isn't a plain name of a file in the
+             folder (contains a path separator, is '..' or hidden)
+    """
+    if not filename or filename.startswith('.') or \
+            os.path.basename(filename) != filename or \
+            safe_path(folder, filename) is None:
+        return None
+
+    return os.path.join(folder, filename)
+
+
+# Names of stored uploads - SHA-256 of the content and the extension
+UPLOAD_NAME = re.compile(r'^[0-9a-f]{64}\.(png|jpg|jpeg|gif|ico)$')
+
+
+def is_upload_name(filename):
+    """
+    :return: True if filename has the form of a stored upload's name (see
+             store_upload()) - a plain name, never a path
+    """
+    return isinstance(filename, str) and \
+        UPLOAD_NAME.match(filename) is not None
+
+
+def referenced_pictures(session, filenames, models):
+    """
+    Finds which of the pictures are still used by any record.
+
+    :param session: SQLAlchemy session
+    :param filenames: Names of the pictures
+    :param models: Model classes with 'picture' column
+    :return: set of names of pictures that are still referenced
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return set()
+
+    referenced = set()
+    for model in models:
+        referenced.update(picture for picture, in session.query(
+                model.picture).filter(model.picture.in_(filenames))
+                          .distinct())
+
+    return referenced
+
+
+##
+# SERVING UPLOADS
+##
+
+# Seconds browsers may keep an uploaded file
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
+
+def send_upload(folder, filename, sendfile=None, accel_prefix='/uploads/'):
+    """
+    Sends an uploaded file (or it's variant). Files are named after their
+    content, so the name is a strong ETag and the file may be cached forever.
+    Conditional requests are answered with 304 without opening the file.
+
+    With sendfile set, only headers are sent and the front proxy reads the
+    file - 'x-sendfile' (Apache, lighttpd) passes the path of the file,
+    'x-accel-redirect' (nginx) the URL of it's internal location.
+
+    :param folder: Folder with uploaded files
+    :param filename: Name of the file
+    :param sendfile: None, 'x-sendfile' or 'x-accel-redirect'
+    :param accel_prefix: Internal nginx location of the folder
+    :return: Response
+    """
+    path = safe_join(folder, filename)
+    if path.endswith('.tmp') or not os.path.isfile(path):
+        # .tmp files are uploads being written
+        abort(404)
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    if sendfile is None:
+        response = send_file(path, add_etags=False,
+                             cache_timeout=UPLOAD_MAX_AGE)
+    else:
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or
+                            'application/octet-stream')
+        if sendfile == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = accel_prefix + \
+                url_quote(filename)
+        else:
+            response.headers['X-Sendfile'] = path
+
+    response.set_etag(filename)
+    response.last_modified = int(stat.st_mtime)
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable' \
+        .format(UPLOAD_MAX_AGE)
+
+    if sendfile is None:
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=stat.st_size)
+
+    return response.make_conditional(request)
+
+
+##
+# BACKGROUND DELETION
+##
+
+
+def remove_upload(folder, filename, queued_at):
+    """
+    Deletes uploaded picture together with it's resized variants. The file
+    is kept if it was uploaded again after it was queued for deletion.
+
+    :param folder: Folder with uploaded files
+    :param filename: Name of the picture
+    :param queued_at: Time the deletion was queued (time.time())
+    :return: True if the picture was deleted
+    """
+    path = upload_path(folder, filename)
+    if path is None:
+        # never deletes anything outside of the folder
+        return False
+
+    try:
+        if os.path.getmtime(path) > queued_at:
+            return False
+        os.remove(path)
+    except OSError:
+        # already deleted
+        return False
+
+    for variant in all_variant_filenames(filename):
+        try:
+            os.remove(upload_path(folder, variant))
+        except OSError:
+            # variant wasn't generated (yet)
+            pass
+
+    return True
+
+
+class PictureReaper(object):
+    """
+    Deletes uploaded files queued in the pending deletion table, in a
+    background thread. Requests only insert the rows in their transaction,
+    so deleting a large category doesn't wait for the file system and no
+    file is orphaned by a crash - the queue is picked up after restart.
+    Files still used by a record are not deleted.
+    """
+
+    def __init__(self, session_factory, folder, pending_model, models,
+                 interval=60, batch_size=100):
+        """
+        :param session_factory: Callable returning a new SQLAlchemy session
+        :param folder: Folder with uploaded files
+        :param pending_model: Model of the queue (model.PendingDeletion)
+        :param models: Model classes with 'picture' column
+        :param interval: Seconds between checks of the queue when nobody
+                         calls wake()
+        :param batch_size: Number of files handled in one transaction
+        """
+        self.session_factory = session_factory
+        self.folder = folder
+        self.pending_model = pending_model
+        self.models = models
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts the background thread, once in every process (threads don't
+        survive fork). The queue is checked straight away, so deletions left
+        by a previous run are finished.
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            thread = threading.Thread(target=self.run, name='picture-reaper')
+            thread.daemon = True
+            self._wake.set()
+            thread.start()
+            self._pid = os.getpid()
+
+    def wake(self):
+        """
+        Makes the thread check the queue now - called after a commit that
+        queued some deletions.
+        """
+        self._wake.set()
+
+    def stop(self):
+        """
+        Ends the background thread after it's current batch, e.g. when the
+        app is configured again with another reaper.
+        """
+        self._stopped = True
+        self._wake.set()
+
+    def run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopped:
+                break
+
+            try:
+                while self.reap() == self.batch_size:
+                    pass
+            except Exception:
+                log.exception("There was an error deleting queued files.")
+
+    def reap(self):
+        """
+        Handles one batch of the queue.
+
+        :return: Number of handled queued deletions
+        """
+        pending = self.pending_model
+        session = self.session_factory()
+
+        try:
+            queued = session.query(pending.id, pending.filename,
+                                   pending.queued_at) \
+                .order_by(pending.id).limit(self.batch_size).all()
+            if not queued:
+                return 0
+
+            referenced = referenced_pictures(
+                    session, {filename for id, filename, queued_at in queued},
+                    self.models)
+
+            for id, filename, queued_at in queued:
+                if filename not in referenced:
+                    remove_upload(self.folder, filename, queued_at)
+
+            session.query(pending) \
+                .filter(pending.id.in_([id for id, filename, queued_at
+                                        in queued])) \
+                .delete(synchronize_session=False)
+            session.commit()
+
+            return len(queued)
+
+        finally:
+            session.close()